@@ -0,0 +1,152 @@
+/*
+Memoized results for hot queries.
+An in-process LRU with a TTL, optionally backed by a shared SQLite file so several server workers
+can reuse each other's results.
+Entries are tagged with the ingest generation (see uoft/generation.py) they were computed against.
+The generation is re-read at most every GENERATION_CHECK_MS, so results from before an ingest can
+still be served for up to that long after it. After that, older entries are never served again.
+The shared SQLite file is bounded too: expired rows are deleted, and only the newest maxDiskEntries
+rows are kept.
+*/
+
+const DEFAULT_MAX_ENTRIES = 500;
+const DEFAULT_TTL_MS = 10 * 60 * 1000;
+const DEFAULT_MAX_DISK_ENTRIES = 5000;
+// how often to re-read the generation counter from the database
+const GENERATION_CHECK_MS = 1000;
+
+class QueryCache {
+    /**
+     * @param knex - connection to the course database, to read the generation from
+     * @param {object} options
+     * @param {number} options.maxEntries - evict least-recently-used entries past this size
+     * @param {number} options.ttlMs - entries older than this are recomputed
+     * @param {string | null} options.diskPath - SQLite file shared between workers,
+     *   or null for memory only
+     * @param {number} options.maxDiskEntries - keep at most this many rows in the SQLite file
+     */
+    constructor(knex, {
+        maxEntries = DEFAULT_MAX_ENTRIES, ttlMs = DEFAULT_TTL_MS, diskPath = null,
+        maxDiskEntries = DEFAULT_MAX_DISK_ENTRIES,
+    } = {}) {
+        this.knex = knex;
+        this.maxEntries = maxEntries;
+        this.maxDiskEntries = maxDiskEntries;
+        this.ttlMs = ttlMs;
+        // Map iterates in insertion order, so the first key is always the least recently used
+        this.entries = new Map();
+        this.generation = null;
+        this.generationCheckedAt = 0;
+        this.stats = {
+            hits: 0, diskHits: 0, misses: 0, evictions: 0, invalidations: 0,
+        };
+
+        this.disk = null;
+        if (diskPath) {
+            // eslint-disable-next-line global-require
+            this.disk = require('knex')({
+                client: 'sqlite3',
+                connection: { filename: diskPath },
+                useNullAsDefault: true,
+            });
+            this.diskReady = this.disk.raw(`CREATE TABLE IF NOT EXISTS query_cache
+                (key VARCHAR PRIMARY KEY, generation INTEGER, expires INTEGER, value TEXT)`);
+        }
+    }
+
+    async getGeneration() {
+        const now = Date.now();
+        if (this.generation === null || now - this.generationCheckedAt > GENERATION_CHECK_MS) {
+            const hasTable = await this.knex.schema.hasTable('ingest_generation');
+            const row = hasTable
+                ? await this.knex('ingest_generation').where('id', 0).first('generation') : null;
+            const generation = row ? row.generation : 0;
+            if (this.generation !== null && generation !== this.generation) {
+                this.stats.invalidations += this.entries.size;
+                this.entries.clear();
+            }
+            this.generation = generation;
+            this.generationCheckedAt = now;
+        }
+        return this.generation;
+    }
+
+    set(key, entry) {
+        this.entries.delete(key);
+        this.entries.set(key, entry);
+        while (this.entries.size > this.maxEntries) {
+            this.entries.delete(this.entries.keys().next().value);
+            this.stats.evictions++;
+        }
+    }
+
+    async getFromDisk(key, generation, now) {
+        await this.diskReady;
+        const row = await this.disk('query_cache').where('key', key).first();
+        if (row && row.generation === generation && row.expires > now) {
+            return { value: JSON.parse(row.value), expires: row.expires, generation };
+        }
+        return null;
+    }
+
+    async putOnDisk(key, generation, entry) {
+        await this.diskReady;
+        await this.disk.raw('INSERT OR REPLACE INTO query_cache (key, generation, expires, value) VALUES (?, ?, ?, ?)',
+            [key, generation, entry.expires, JSON.stringify(entry.value)]);
+        // clean out results from older ingests, and expired ones
+        await this.disk('query_cache')
+            .where('generation', '<', generation)
+            .orWhere('expires', '<=', Date.now())
+            .del();
+        // keys come from user input, so bound the number of rows as well
+        await this.disk.raw(`DELETE FROM query_cache WHERE key NOT IN
+            (SELECT key FROM query_cache ORDER BY expires DESC LIMIT ?)`, [this.maxDiskEntries]);
+    }
+
+    /**
+     * Return the cached value for key, or compute, cache and return it.
+     * @param {string} key
+     * @param {function(number): Promise<any>} compute - called with the current generation
+     */
+    async get(key, compute) {
+        const generation = await this.getGeneration();
+        const now = Date.now();
+
+        // an ingest can land while a value is being computed, so check the entry's own generation
+        const entry = this.entries.get(key);
+        if (entry && entry.generation === generation && entry.expires > now) {
+            this.stats.hits++;
+            this.set(key, entry);
+            return entry.value;
+        }
+
+        if (this.disk) {
+            const diskEntry = await this.getFromDisk(key, generation, now);
+            if (diskEntry) {
+                this.stats.diskHits++;
+                this.set(key, diskEntry);
+                return diskEntry.value;
+            }
+        }
+
+        this.stats.misses++;
+        const value = await compute(generation);
+        const newEntry = { value, expires: now + this.ttlMs, generation };
+        this.set(key, newEntry);
+        if (this.disk) {
+            await this.putOnDisk(key, generation, newEntry);
+        }
+        return value;
+    }
+
+    getStats() {
+        return {
+            ...this.stats,
+            size: this.entries.size,
+            maxEntries: this.maxEntries,
+            generation: this.generation,
+        };
+    }
+}
+
+module.exports = { QueryCache };
@@ -0,0 +1,235 @@
+/*
+Find offerings that fit around an existing timetable.
+Reads the timetable_sections and timetable_slots tables written by uoft/schedule_query.py at ingest.
+See that file for how the slot masks are built.
+*/
+
+/* eslint-disable no-bitwise */
+// slot masks are bitsets, so bitwise operators are the point of this file
+
+const DAYS = 'MTWRF';
+const DAY_SLOTS = 48n;
+// a full-year (Y) course meets in both the fall (F) and winter (S) terms
+const TERM_OVERLAP = {
+    F: ['F', 'Y'],
+    S: ['S', 'Y'],
+    Y: ['F', 'S', 'Y'],
+};
+// a chosen section, ex. "CSC108H1-L0101", "CSC108H1 T0101", or just the course code
+const SECTION_ID_PATTERN = /^(\w\w\w\d\d\d\w\d)(?:[\s:-]*([A-Z]\d{4}))?$/;
+
+/**
+ * @param {bigint} n
+ * @returns {number}
+ */
+function popCount(n) {
+    let count = 0;
+    let x = n;
+    while (x > 0n) {
+        x &= x - 1n;
+        count++;
+    }
+    return count;
+}
+
+/**
+ * Breadth filter is either the category number (ex. "5") or part of its name
+ * @param {string} breadth
+ * @param {string | null} courseBreadth
+ * @returns {boolean}
+ */
+function matchesBreadth(breadth, courseBreadth) {
+    if (!courseBreadth) {
+        return false;
+    }
+    if (/^\d+$/.test(breadth)) {
+        return courseBreadth.includes(`(${breadth})`);
+    }
+    return courseBreadth.toLowerCase().includes(breadth.toLowerCase());
+}
+
+/**
+ * @param {string} sectionId - ex. "CSC108H1-L0101", or just "CSC108H1" for all of its sections
+ * @returns {{code: string, section: (string|null)}}
+ */
+function parseSectionId(sectionId) {
+    const id = sectionId.trim().toUpperCase();
+    const m = SECTION_ID_PATTERN.exec(id);
+    if (!m) {
+        return { code: id, section: null };
+    }
+    return { code: m[1], section: m[2] || null };
+}
+
+/**
+ * @param {string} code
+ * @param {string} section
+ * @returns {string} key of a section in the index
+ */
+function sectionKey(code, section) {
+    return `${code}-${section}`;
+}
+
+class ScheduleIndex {
+    constructor(sections, slotRows) {
+        // section key -> {term, week, days, numSlots}
+        // week packs the per-day masks side by side so a conflict check is a single AND
+        this.slots = {};
+        this.sections = {};
+        // code -> keys of its sections
+        this.byCode = {};
+        this.byTerm = { F: [], S: [], Y: [] };
+
+        const dayMasks = {};
+        slotRows.forEach((row) => {
+            const key = sectionKey(row.code, row.section);
+            if (!(key in dayMasks)) {
+                dayMasks[key] = {};
+            }
+            dayMasks[key][row.day] = BigInt(row.mask);
+        });
+
+        sections.forEach((section) => {
+            if (!(section.term in TERM_OVERLAP)) {
+                // header rows and junk
+                return;
+            }
+            const key = sectionKey(section.code, section.section);
+            const masks = dayMasks[key] || {};
+            let week = 0n;
+            let days = 0n;
+            for (let i = 0; i < DAYS.length; i++) {
+                const mask = masks[DAYS[i]] || 0n;
+                week |= mask << (BigInt(i) * DAY_SLOTS);
+                if (mask) {
+                    days |= 1n << BigInt(i);
+                }
+            }
+            this.sections[key] = section;
+            this.slots[key] = {
+                term: section.term, week, days, numSlots: popCount(week),
+            };
+            if (!(section.code in this.byCode)) {
+                this.byCode[section.code] = [];
+            }
+            this.byCode[section.code].push(key);
+            this.byTerm[section.term].push(key);
+        });
+    }
+
+    /**
+     * @param {string[]} chosen - sections already in the timetable (ex. CSC108H1-L0101),
+     *   a course code alone means all of its sections
+     * @returns {object} map from term to combined {week, days} of the chosen sections
+     */
+    occupancy(chosen) {
+        const occ = {};
+        Object.keys(TERM_OVERLAP).forEach((term) => {
+            occ[term] = { week: 0n, days: 0n };
+        });
+        chosen.forEach((sectionId) => {
+            const { code, section } = parseSectionId(sectionId);
+            const keys = section === null ? (this.byCode[code] || []) : [sectionKey(code, section)];
+            keys.forEach((key) => {
+                const slot = this.slots[key];
+                if (!slot) {
+                    return;
+                }
+                TERM_OVERLAP[slot.term].forEach((term) => {
+                    occ[term].week |= slot.week;
+                    occ[term].days |= slot.days;
+                });
+            });
+        });
+        return occ;
+    }
+
+    /**
+     * Return a page of sections in the given term that don't conflict with the chosen ones.
+     * Sections of courses already chosen are left out.
+     * Ranked by fewest new days on campus, then fewest hours, then code. TBA sections come last.
+     */
+    query({
+        chosen, term, breadth = null, dept = null, page = 1, perPage = 25,
+    }) {
+        const occ = this.occupancy(chosen);
+        const chosenCodes = new Set(chosen.map((sectionId) => {
+            return parseSectionId(sectionId).code;
+        }));
+        const busyDays = occ[term].days;
+        const deptPrefix = dept ? dept.toUpperCase() : null;
+
+        const ranked = [];
+        TERM_OVERLAP[term].forEach((t) => {
+            const busy = occ[t].week;
+            this.byTerm[t].forEach((key) => {
+                const slot = this.slots[key];
+                const { code, BreadthRequirement } = this.sections[key];
+                if ((slot.week & busy) || chosenCodes.has(code)) {
+                    return;
+                }
+                if (deptPrefix && !code.startsWith(deptPrefix)) {
+                    return;
+                }
+                if (breadth && !matchesBreadth(breadth, BreadthRequirement)) {
+                    return;
+                }
+                ranked.push({
+                    key,
+                    tba: slot.week === 0n ? 1 : 0,
+                    newDays: popCount(slot.days & ~busyDays),
+                    numSlots: slot.numSlots,
+                });
+            });
+        });
+
+        ranked.sort((a, b) => {
+            if (a.tba !== b.tba) {
+                return a.tba - b.tba;
+            } else if (a.newDays !== b.newDays) {
+                return a.newDays - b.newDays;
+            } else if (a.numSlots !== b.numSlots) {
+                return a.numSlots - b.numSlots;
+            } else if (a.key > b.key) {
+                return 1;
+            } else if (a.key < b.key) {
+                return -1;
+            } else {
+                return 0;
+            }
+        });
+
+        const start = (page - 1) * perPage;
+        return {
+            total: ranked.length,
+            page,
+            perPage,
+            results: ranked.slice(start, start + perPage).map((r) => {
+                return this.sections[r.key];
+            }),
+        };
+    }
+}
+
+/**
+ * Build the index from the database
+ * @param knex
+ * @returns {Promise<ScheduleIndex>}
+ */
+async function loadScheduleIndex(knex) {
+    const hasCourses = await knex.schema.hasTable('courses');
+    const query = knex('timetable_sections as s')
+        .leftJoin('timetable as t', 't.code', 's.code')
+        .select('s.code', 's.term', 't.name', 's.section', 's.time', 's.location',
+            's.instructor');
+    if (hasCourses) {
+        query.leftJoin('courses as c', 'c.code', 's.code').select('c.BreadthRequirement');
+    }
+    const sections = await query;
+    const slotRows = await knex('timetable_slots').select('code', 'section', 'day', 'mask');
+    return new ScheduleIndex(sections, slotRows);
+}
+
+module.exports = {
+    ScheduleIndex, loadScheduleIndex, parseSectionId, TERM_OVERLAP,
+};
@@ -0,0 +1,158 @@
+/*
+Typo-tolerant course code and title lookup, for autocomplete.
+Reads the course_trigrams table written by uoft/course_search.py at ingest.
+See that file for how courses are ranked.
+*/
+
+// a query that looks like the start of a course code, with or without the campus suffix (H1/Y1)
+const CODE_PREFIX_PATTERN = /^[A-Z]{3}(\d{1,3}([HY](\d)?)?)?$/;
+
+/**
+ * @param {string} s
+ * @returns {Set<string>} trigrams of each word, padded so the start of a word counts more
+ */
+function trigrams(s) {
+    const grams = new Set();
+    const words = s.toLowerCase().split(/[^a-z0-9]+/).filter((word) => {
+        return word.length > 0;
+    });
+    words.forEach((word) => {
+        const padded = `  ${word} `;
+        for (let i = 0; i < padded.length - 2; i++) {
+            grams.add(padded.slice(i, i + 3));
+        }
+    });
+    return grams;
+}
+
+/**
+ * @param {string} s - ex. "csc 108", "Csc-108h1"
+ * @returns {string} ex. "CSC108", "CSC108H1"
+ */
+function normalizeCode(s) {
+    return s.replace(/[^A-Za-z0-9]/g, '').toUpperCase();
+}
+
+class CourseSearch {
+    constructor(names, trigramRows) {
+        this.names = names;
+        // trigram -> codes of courses that have it
+        this.postings = new Map();
+        // code -> number of trigrams the course has
+        this.sizes = new Map();
+        trigramRows.forEach((row) => {
+            if (!this.postings.has(row.trigram)) {
+                this.postings.set(row.trigram, []);
+            }
+            this.postings.get(row.trigram).push(row.code);
+            this.sizes.set(row.code, (this.sizes.get(row.code) || 0) + 1);
+        });
+        this.codes = [...this.sizes.keys()].sort();
+    }
+
+    /**
+     * @param {string} prefix
+     * @returns {string[]} codes starting with prefix
+     */
+    codeMatches(prefix) {
+        let lo = 0;
+        let hi = this.codes.length;
+        while (lo < hi) {
+            const mid = Math.floor((lo + hi) / 2);
+            if (this.codes[mid] < prefix) {
+                lo = mid + 1;
+            } else {
+                hi = mid;
+            }
+        }
+        const matches = [];
+        while (lo < this.codes.length && this.codes[lo].startsWith(prefix)) {
+            matches.push(this.codes[lo]);
+            lo++;
+        }
+        return matches;
+    }
+
+    /**
+     * Courses whose code starts with the query come first,
+     * the rest are ranked by the fraction of the query's trigrams they share,
+     * then by overall similarity
+     * @param {string} query
+     * @param {number} limit
+     * @returns {{code: string, name: string, score: number}[]}
+     */
+    search(query, limit = 10) {
+        const results = [];
+        const seen = new Set();
+
+        const code = normalizeCode(query);
+        if (code && CODE_PREFIX_PATTERN.test(code)) {
+            this.codeMatches(code).slice(0, limit).forEach((match) => {
+                results.push({ code: match, name: this.names[match] || null, score: 1 });
+                seen.add(match);
+            });
+        }
+        if (results.length >= limit) {
+            return results;
+        }
+
+        const grams = trigrams(query);
+        if (grams.size === 0) {
+            return results;
+        }
+        const shared = new Map();
+        grams.forEach((gram) => {
+            (this.postings.get(gram) || []).forEach((match) => {
+                shared.set(match, (shared.get(match) || 0) + 1);
+            });
+        });
+
+        const ranked = [];
+        shared.forEach((n, match) => {
+            if (!seen.has(match)) {
+                ranked.push({
+                    code: match,
+                    coverage: n / grams.size,
+                    similarity: n / (grams.size + this.sizes.get(match) - n),
+                });
+            }
+        });
+        ranked.sort((a, b) => {
+            return b.coverage - a.coverage
+                || b.similarity - a.similarity
+                || (a.code < b.code ? -1 : 1);
+        });
+
+        ranked.slice(0, limit - results.length).forEach((r) => {
+            results.push({
+                code: r.code,
+                name: this.names[r.code] || null,
+                score: Math.round(r.coverage * 1000) / 1000,
+            });
+        });
+        return results;
+    }
+}
+
+/**
+ * @param knex
+ * @returns {Promise<CourseSearch>}
+ */
+async function loadCourseSearch(knex) {
+    const tables = ['timetable', 'courses'];
+    const rows = await Promise.all(tables.map(async (table) => {
+        return (await knex.schema.hasTable(table)) ? knex(table).select('code', 'name') : [];
+    }));
+    // calendar names win over timetable names, same as uoft/course_search.py
+    const names = {};
+    rows.flat().forEach((row) => {
+        if (row.code && row.name) {
+            names[row.code] = row.name;
+        }
+    });
+    const trigramRows = (await knex.schema.hasTable('course_trigrams'))
+        ? await knex('course_trigrams').select('trigram', 'code') : [];
+    return new CourseSearch(names, trigramRows);
+}
+
+module.exports = { CourseSearch, loadCourseSearch };
@@ -7,8 +7,11 @@ However I find it easier to write in node now and I want to make this repo usabl
 // constants
 const PORT = 5050;
 const DB_FILE = './courses.db';
+// set this to share cached query results between server workers
+const QUERY_CACHE_DB = process.env.QUERY_CACHE_DB || null;
 
 // imports
+const zlib = require('zlib');
 const express = require('express');
 const morgan = require('morgan');
 const knex = require('knex')({
@@ -18,6 +21,9 @@ const knex = require('knex')({
     },
 });
 const bookshelf = require('bookshelf')(knex);
+const { loadScheduleIndex, TERM_OVERLAP } = require('./schedule');
+const { QueryCache } = require('./cache');
+const { loadCourseSearch } = require('./search');
 
 const app = express();
 
@@ -29,21 +35,249 @@ const Offering = bookshelf.model('Offering', {
     tableName: 'timetable',
 });
 
+const queryCache = new QueryCache(knex, { diskPath: QUERY_CACHE_DB });
+
+// built on first use, and rebuilt when an ingest changes the timetable
+let scheduleIndex = null;
+let scheduleIndexGeneration = null;
+// same, for course lookups
+let courseSearch = null;
+let courseSearchGeneration = null;
+
 // app config
 app.use(morgan('dev'));
 app.use('/', express.static('public'));
 
+/**
+ * A parameter given more than once (?a=1&a=2) arrives as an array, and a bracketed one (?a[b]=1)
+ * as an object, so check the query has at most one string for each of the given parameters
+ * @param {object} query - req.query
+ * @param {string[]} names
+ * @returns {string | null} an error to send, or null if the parameters are fine
+ */
+function checkStringParams(query, names) {
+    const bad = names.filter((name) => {
+        return query[name] !== undefined && typeof query[name] !== 'string';
+    });
+    return bad.length > 0 ? `${bad.join(', ')} must be given once` : null;
+}
+
+/**
+ * @param {string | undefined} value - a query parameter already checked by checkStringParams
+ * @param {number} fallback - used when the parameter wasn't given
+ * @returns {number | null} the value as a positive integer, or null if it isn't one
+ */
+function positiveIntParam(value, fallback) {
+    if (value === undefined || value === '') {
+        return fallback;
+    }
+    if (!/^\d+$/.test(value)) {
+        return null;
+    }
+    const n = Number.parseInt(value, 10);
+    return n > 0 ? n : null;
+}
+
 // routes
 app.get('/api/offerings', async (req, res) => {
-    const offerings = await Offering.fetchAll();
+    const offerings = await queryCache.get('offerings', async () => {
+        return (await Offering.fetchAll()).toJSON();
+    });
     res.json(offerings);
 });
 
 app.get('/api/courses', async (req, res) => {
-    const courses = await Course.fetchAll();
+    const courses = await queryCache.get('courses', async () => {
+        return (await Course.fetchAll()).toJSON();
+    });
     res.json(courses);
 });
 
+/**
+ * Sections that fit around the given sections (a course code alone means all of its sections)
+ * ?sections=CSC108H1-L0101,MAT137Y1-L0101&term=F&breadth=5&dept=CSC&page=1&perPage=25
+ */
+app.get('/api/schedule', async (req, res) => {
+    const error = checkStringParams(req.query,
+        ['sections', 'term', 'breadth', 'dept', 'page', 'perPage']);
+    if (error) {
+        res.status(400).json({ error });
+        return;
+    }
+    const term = req.query.term || 'F';
+    if (!Object.prototype.hasOwnProperty.call(TERM_OVERLAP, term)) {
+        res.status(400).json({ error: `unknown term ${term}` });
+        return;
+    }
+    const page = positiveIntParam(req.query.page, 1);
+    const perPage = positiveIntParam(req.query.perPage, 25);
+    if (page === null || perPage === null) {
+        res.status(400).json({ error: 'page and perPage must be positive integers' });
+        return;
+    }
+    const params = {
+        chosen: req.query.sections ? req.query.sections.split(',').sort() : [],
+        term,
+        breadth: req.query.breadth || null,
+        dept: req.query.dept || null,
+        page,
+        perPage,
+    };
+    try {
+        // the timetable parser builds the index; a database without it can't answer
+        const tables = await Promise.all(['timetable_sections', 'timetable_slots'].map((table) => {
+            return knex.schema.hasTable(table);
+        }));
+        if (tables.includes(false)) {
+            res.status(503).json({ error: 'the schedule index has not been built' });
+            return;
+        }
+        const result = await queryCache.get(`schedule:${JSON.stringify(params)}`, async (generation) => {
+            if (!scheduleIndex || scheduleIndexGeneration !== generation) {
+                scheduleIndex = await loadScheduleIndex(knex);
+                scheduleIndexGeneration = generation;
+            }
+            return scheduleIndex.query(params);
+        });
+        res.json(result);
+    } catch (err) {
+        res.status(500).json({ error: err.message });
+    }
+});
+
+/**
+ * Courses matching a (possibly misspelled or partial) code or title, best first
+ * ?q=csc 108&limit=10
+ */
+app.get('/api/search', async (req, res) => {
+    const error = checkStringParams(req.query, ['q', 'limit']);
+    if (error) {
+        res.status(400).json({ error });
+        return;
+    }
+    const q = (req.query.q || '').trim();
+    const limit = positiveIntParam(req.query.limit, 10);
+    if (limit === null) {
+        res.status(400).json({ error: 'limit must be a positive integer' });
+        return;
+    }
+    if (!q) {
+        res.json([]);
+        return;
+    }
+    try {
+        // searching is cheap, so don't fill the query cache with every keystroke
+        const generation = await queryCache.getGeneration();
+        if (!courseSearch || courseSearchGeneration !== generation) {
+            courseSearch = await loadCourseSearch(knex);
+            courseSearchGeneration = generation;
+        }
+        res.json(courseSearch.search(q, Math.min(limit, 100)));
+    } catch (err) {
+        res.status(500).json({ error: err.message });
+    }
+});
+
+/**
+ * Send a document pre-compressed by uoft/course_documents.py,
+ * in the best encoding the client accepts
+ * @param req
+ * @param res
+ * @param {object} row - has gzip and (if brotli was installed at build time) br columns
+ */
+function sendPrecompressed(req, res, row) {
+    res.set('Content-Type', 'application/json');
+    res.set('Vary', 'Accept-Encoding');
+    const encoding = req.acceptsEncodings(row.br ? ['br', 'gzip'] : ['gzip']);
+    if (encoding === 'br' || encoding === 'gzip') {
+        res.set('Content-Encoding', encoding);
+        res.send(encoding === 'br' ? row.br : row.gzip);
+    } else {
+        res.send(zlib.gunzipSync(row.gzip));
+    }
+}
+
+/**
+ * Fetch a row of a course document table, or answer the request if there isn't one
+ * @param res
+ * @param {string} table - course_documents or course_documents_bulk
+ * @param {function(): Promise<object>} fetchRow
+ * @param {string} notFound - error to send when the table has no such row
+ * @returns {Promise<object | null>} the row, or null if the request has been answered
+ */
+async function fetchDocument(res, table, fetchRow, notFound) {
+    try {
+        // a database written before the documents were built has no table yet
+        if (!(await knex.schema.hasTable(table))) {
+            res.status(503).json({ error: 'course documents have not been built' });
+            return null;
+        }
+        const row = await fetchRow();
+        if (!row) {
+            res.status(404).json({ error: notFound });
+            return null;
+        }
+        return row;
+    } catch (err) {
+        res.status(500).json({ error: err.message });
+        return null;
+    }
+}
+
+// one course, joined with all of its sections
+app.get('/api/course/:code', async (req, res) => {
+    const code = req.params.code.toUpperCase();
+    const row = await fetchDocument(res, 'course_documents', () => {
+        return knex('course_documents').where('code', code).first('gzip', 'br');
+    }, `no course ${req.params.code}`);
+    if (row) {
+        sendPrecompressed(req, res, row);
+    }
+});
+
+// every course, joined with all of its sections
+app.get('/api/course-documents', async (req, res) => {
+    const row = await fetchDocument(res, 'course_documents_bulk', () => {
+        return knex('course_documents_bulk').where('id', 0).first('gzip', 'br');
+    }, 'course documents have not been built');
+    if (row) {
+        sendPrecompressed(req, res, row);
+    }
+});
+
+/**
+ * Catalogue changes recorded by the parsers since the given sequence number, oldest first
+ * See uoft/changelog.py
+ * ?since=0&limit=1000
+ */
+app.get('/api/changes', async (req, res) => {
+    const since = Number.parseInt(req.query.since || '0', 10);
+    const limit = Math.min(Number.parseInt(req.query.limit || '1000', 10), 10000);
+    if (!(await knex.schema.hasTable('changelog'))) {
+        res.json({ changes: [], lastSeq: since });
+        return;
+    }
+    const rows = await knex('changelog').where('seq', '>', since).orderBy('seq').limit(limit);
+    const changes = rows.map((row) => {
+        return {
+            seq: row.seq,
+            table: row.tbl,
+            code: row.code,
+            op: row.op,
+            changes: JSON.parse(row.changes),
+            recordedAt: row.recorded_at,
+        };
+    });
+    res.json({
+        changes,
+        lastSeq: changes.length > 0 ? changes[changes.length - 1].seq : since,
+    });
+});
+
+app.get('/api/cache/stats', (req, res) => {
+    res.json(queryCache.getStats());
+});
+
 // start the server
 app.listen(PORT, () => {
     // eslint-disable-next-line
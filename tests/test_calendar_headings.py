@@ -0,0 +1,76 @@
+"""Check how the calendar parser finds the department headings of a page, in batch and --stream mode."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from uoft.calendar_page_parser import iter_course_page, page_title, parse_course_page
+
+COURSE = """<a name="%s"></a><p><strong>%s&nbsp;&nbsp;&nbsp; %s [24L/12T]</strong></p>
+<p>Some description.</p>
+Prerequisite: CSC108H1<br>
+Breadth Requirement: The Physical and Mathematical Universes (5)<br>
+"""
+
+# an aggregate page, with a paragraph that looks like a heading inside the Biology listing
+LIFE_SCIENCES_PAGE = ("<html><body><h1>Life Sciences</h1><p>Intro text about programs.</p><h2>Biology Courses</h2>\n"
+	+ COURSE % ("BIO120H1", "BIO120H1", "Adaptation")
+	+ "<p>Other Courses</p>\n"
+	+ COURSE % ("BIO130H1", "BIO130H1", "Molecular Biology")
+	+ "<h2>Ecology and Evolutionary Biology Courses</h2>\n"
+	+ COURSE % ("EEB214H1", "EEB214H1", "Evolution")
+	+ '<div id="footer">footer</div></body></html>')
+
+# the department name has an entity in it
+NMC_PAGE = ("<html><body><h1>Near &amp; Middle Eastern Civilizations</h1><p>Intro text about programs.</p>"
+	+ "<h2>Near &amp; Middle Eastern Civilizations Courses</h2>\n"
+	+ COURSE % ("NMC101H1", "NMC101H1", "Intro to NMC")
+	+ COURSE % ("NMC102H1", "NMC102H1", "More NMC")
+	+ '<div id="footer">footer</div></body></html>')
+
+
+class DepartmentHeadingTest(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def _page(self, name, html):
+		path = os.path.join(self.dir, name)
+		with open(path, "w") as fp:
+			fp.write(html)
+		return path
+
+	def _departments(self, courses):
+		return [(course["code"], course["department"]) for course in courses]
+
+	def test_aggregate_page(self):
+		path = self._page("2012-2013 Calendar - Life Sciences.htm", LIFE_SCIENCES_PAGE)
+		expected = [
+			("BIO120H1", "Biology"),
+			("BIO130H1", "Biology"),
+			("EEB214H1", "Ecology and Evolutionary Biology"),
+		]
+		self.assertEqual(self._departments(parse_course_page(path, aggregate=True)), expected)
+		self.assertEqual(self._departments(iter_course_page(path, aggregate=True)), expected)
+
+	def test_escaped_department_name(self):
+		path = self._page("nmc.htm", NMC_PAGE)
+		courses = parse_course_page(path)
+		self.assertEqual(self._departments(courses), [
+			("NMC101H1", "Near & Middle Eastern Civilizations"),
+			("NMC102H1", "Near & Middle Eastern Civilizations"),
+		])
+		self.assertEqual(list(iter_course_page(path)), courses)
+
+	def test_page_title(self):
+		self.assertEqual(page_title("data/archive-capture-2011-2012/calendar-files/2011-2012 Calendar - Life Sciences.htm"),
+			"Life Sciences")
+		self.assertEqual(page_title("Biology.htm"), "Biology")
+
+
+if __name__ == "__main__":
+	unittest.main()
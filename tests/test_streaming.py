@@ -0,0 +1,112 @@
+"""Check that --stream gives the same courses and offerings as parsing the whole page,
+and that its memory use stays flat as pages grow.
+The synthetic pages are a few megabytes, mostly long descriptions, so each one only has a few hundred blocks to parse."""
+
+import os
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+import warnings
+
+from uoft.calendar_page_parser import iter_course_page, parse_course_page
+from uoft.timetable_page_parser import TimetableParser
+
+# about 4 KB per course or offering
+FILLER = "Lorem ipsum dolor sit amet &amp; consectetur. " * 90
+
+
+def course_code(i):
+	return "NM%s%03dH1" % (chr(ord("A") + i // 1000), i % 1000)
+
+
+def write_calendar_page(path, n):
+	with open(path, "w") as fp:
+		fp.write("<html><body><h1>Near &amp; Middle Eastern Civilizations</h1><p>%s</p>\n" % FILLER)
+		fp.write("<h2>Near &amp; Middle Eastern Civilizations Courses</h2>\n")
+		for i in range(n):
+			code = course_code(i)
+			fp.write('<a name="%s"></a><span class="strong">%s  Title number %d  [24L]</span>\n' % (code, code, i))
+			fp.write("<p>Description %d %s</p>\n" % (i, FILLER))
+			fp.write("Prerequisite: NMC101H1<br/>\nBreadth Requirement: Creative and Cultural Representations (1)<br/>\n")
+		fp.write('<div id="footer">footer</div></body></html>')
+
+
+def write_timetable_page(path, n):
+	with open(path, "w") as fp:
+		fp.write("<html><body><h2><font>Near and Middle Eastern Civilizations [NMC courses]</font></h2>")
+		fp.write("<table border=1><tr><th>Course</th></tr>\n")
+		for i in range(n):
+			fp.write("<tr><td>%s</td><td>F</td><td>Name &amp; %d</td><td>L0101</td><td>Y</td><td>T10-12</td>"
+				"<td>BA1130</td><td>%s</td><td>P</td><td>See</td></tr>\n" % (course_code(i), i, FILLER))
+			fp.write("<tr><td>&nbsp;</td><td></td><td></td><td>T0101</td><td></td><td>F1</td><td>SS</td><td>TA</td></tr>\n")
+		fp.write("</table><p>end</p></body></html>")
+
+
+def peak_memory(rows):
+	"""Consume the generator and return the most memory allocated at once while doing so.
+	Warnings are ignored, since test runners that record them (ex. pytest) would otherwise grow with the page."""
+
+	with warnings.catch_warnings():
+		warnings.simplefilter("ignore")
+		tracemalloc.start()
+		try:
+			for _ in rows:
+				pass
+			return tracemalloc.get_traced_memory()[1]
+		finally:
+			tracemalloc.stop()
+
+
+class StreamingTest(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def _page(self, write_page, name, n):
+		path = os.path.join(self.dir, name)
+		write_page(path, n)
+		return path
+
+	def _check_memory(self, small_path, big_path, iter_page):
+		big_size = os.path.getsize(big_path)
+		self.assertGreater(big_size, 4 * 1024 * 1024)
+
+		# parse once first, so imports and caches filled on first use aren't counted
+		peak_memory(iter_page(small_path))
+		small_peak = peak_memory(iter_page(small_path))
+		big_peak = peak_memory(iter_page(big_path))
+		# four times the page, about the same memory
+		self.assertLess(big_peak, small_peak * 1.5)
+		self.assertLess(big_peak, big_size / 4)
+
+	def test_calendar_stream_matches_batch(self):
+		path = self._page(write_calendar_page, "calendar.htm", 1200)
+		courses = list(iter_course_page(path))
+		self.assertEqual(len(courses), 1200)
+		self.assertEqual(courses, parse_course_page(path))
+		self.assertEqual(courses[0]["department"], "Near & Middle Eastern Civilizations")
+
+	def test_calendar_stream_memory(self):
+		small = self._page(write_calendar_page, "small.htm", 300)
+		big = self._page(write_calendar_page, "big.htm", 1200)
+		self._check_memory(small, big, iter_course_page)
+
+	def test_timetable_stream_matches_batch(self):
+		path = self._page(write_timetable_page, "timetable.htm", 1200)
+		offerings = list(TimetableParser.iter_parse(path))
+		# each offering has a lecture and a tutorial section
+		self.assertEqual(len(offerings), 2400)
+		self.assertEqual(offerings, TimetableParser.parse(path))
+
+	def test_timetable_stream_memory(self):
+		small = self._page(write_timetable_page, "small.htm", 300)
+		big = self._page(write_timetable_page, "big.htm", 1200)
+		self._check_memory(small, big, TimetableParser.iter_parse)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,199 @@
+#############################################
+#	MULTI-SESSION COURSE ARCHIVE			#
+#############################################
+
+"""Each session (ex. 2012-2013) is captured and stored in its own database file:
+
+	data/archive-capture-<session>/courses-new.db
+
+so reloading one session never touches the files for the others.
+Every course and offering row is also tagged with its session when it is written, and open_archive
+attaches a set of session databases behind unified courses_all and timetable_all views.
+Cross-session lookups (course_history) only open the sessions they are asked about."""
+
+#####################
+# 	MODULES			#
+#####################
+
+import logging
+import os
+import re
+import sqlite3
+from argparse import ArgumentParser
+from pprint import pprint
+from typing import Any, Dict, List, Optional
+
+#####################
+# 	GLOBAL VARS		#
+#####################
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = "./data"
+DEFAULT_SESSION = "2012-2013"
+SESSION_DIR_FORMAT = "archive-capture-%s"
+SESSION_DB_NAME = "courses-new.db"
+
+session_pattern = re.compile(r"^\d{4}-\d{4}$")
+
+#####################
+# 	CODE			#
+#####################
+
+
+def session_db_path(session: str, archive_dir: str = ARCHIVE_DIR) -> str:
+	"""Path to the database holding a single session."""
+
+	if not session_pattern.match(session):
+		raise ValueError("Session should look like 2012-2013, got %s" % session)
+	return os.path.join(archive_dir, SESSION_DIR_FORMAT % session, SESSION_DB_NAME)
+
+
+def list_sessions(archive_dir: str = ARCHIVE_DIR) -> List[str]:
+	"""Return all sessions that have a database in the archive, oldest first."""
+
+	sessions: List[str] = []
+	if not os.path.isdir(archive_dir):
+		return sessions
+	for dname in sorted(os.listdir(archive_dir)):
+		m = re.match(r"^archive-capture-(\d{4}-\d{4})$", dname)
+		if m and os.path.exists(os.path.join(archive_dir, dname, SESSION_DB_NAME)):
+			sessions.append(m.group(1))
+	return sessions
+
+
+def make_session_dir(db_path: str) -> None:
+	"""Make sure the directory for a session database exists before connecting to it."""
+
+	dname = os.path.dirname(db_path)
+	if dname:
+		os.makedirs(dname, exist_ok=True)
+
+
+class SessionMismatchError(Exception):
+	"""A database already holds rows of a different session than the one being written."""
+	pass
+
+
+def check_session(conn: sqlite3.Connection, table: str, session: str) -> None:
+	"""Raise SessionMismatchError if the table has rows tagged with another session.
+	Tables are keyed by code alone, so writing one session into another's database would overwrite its rows.
+	Rows from before sessions were tracked aren't tagged, and don't count."""
+
+	columns = [row[1] for row in conn.execute("PRAGMA table_info(%s)" % table)]
+	if "session" not in columns:
+		return
+	row = conn.execute("SELECT session FROM %s WHERE session IS NOT NULL AND session != ? LIMIT 1" % table,
+		(session, )).fetchone()
+	if row is not None:
+		raise SessionMismatchError("The %s table already holds rows of session %s, so it can't hold %s. "
+			"Use the archive database of the session instead" % (table, row[0], session))
+
+
+def check_database_session(db_path: str, table: str, session: str) -> None:
+	"""Like check_session, for a database file that may not exist yet."""
+
+	if not os.path.exists(db_path):
+		return
+	conn = sqlite3.connect(db_path)
+	try:
+		check_session(conn, table, session)
+	finally:
+		conn.close()
+
+
+def add_column_if_missing(conn: sqlite3.Connection, table: str, column: str) -> None:
+	"""Databases captured by older versions of the parsers don't have newer columns, so add them."""
+
+	columns = [row[1] for row in conn.execute("PRAGMA table_info(%s)" % table)]
+	if column not in columns:
+		conn.execute("ALTER TABLE %s ADD COLUMN %s VARCHAR" % (table, column))
+
+
+def _schema_name(session: str) -> str:
+	return "s_" + session.replace("-", "_")
+
+
+def _table_columns(conn: sqlite3.Connection, schema: str, table: str) -> List[str]:
+	return [row[1] for row in conn.execute("PRAGMA %s.table_info(%s)" % (schema, table))]
+
+
+def open_archive(sessions: Optional[List[str]] = None, archive_dir: str = ARCHIVE_DIR) -> sqlite3.Connection:
+	"""Attach the given sessions (all of them by default) read-only to a new connection,
+	and create courses_all and timetable_all views over them.
+	The views have a leading session column, so filtering on it only reads the matching databases.
+	SQLite limits the number of attached databases (10 by default), so pass a subset for large archives."""
+
+	if sessions is None:
+		sessions = list_sessions(archive_dir)
+
+	conn = sqlite3.connect(":memory:", uri=True)
+	for session in sessions:
+		path = os.path.abspath(session_db_path(session, archive_dir))
+		if not os.path.exists(path):
+			raise FileNotFoundError("No database for session %s at %s" % (session, path))
+		conn.execute("ATTACH DATABASE ? AS %s" % _schema_name(session), ("file:%s?mode=ro" % path, ))
+
+	for table in ["courses", "timetable"]:
+		selects = []
+		for session in sessions:
+			schema = _schema_name(session)
+			columns = [col for col in _table_columns(conn, schema, table) if col != "session"]
+			if len(columns) == 0:
+				# this session has no table of this kind
+				continue
+			selects.append("SELECT '%s' AS session, %s FROM %s.%s" % (session, ", ".join(columns), schema, table))
+		if len(selects) > 0:
+			conn.execute("CREATE TEMP VIEW %s_all AS %s" % (table, " UNION ALL ".join(selects)))
+	return conn
+
+
+def course_history(code: str, sessions: Optional[List[str]] = None, archive_dir: str = ARCHIVE_DIR) -> List[dict]:
+	"""Return the calendar entry and offering of a course in each of the given sessions (default all).
+	Each session database is opened read-only, and only for a primary key lookup."""
+
+	if sessions is None:
+		sessions = list_sessions(archive_dir)
+
+	history = []
+	for session in sessions:
+		path = os.path.abspath(session_db_path(session, archive_dir))
+		if not os.path.exists(path):
+			logger.warning("No database for session %s", session)
+			continue
+		conn = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+		conn.row_factory = sqlite3.Row
+		d: Dict[str, Any] = {"session": session}
+		for table in ["courses", "timetable"]:
+			try:
+				row = conn.execute("SELECT * FROM %s WHERE code=?" % table, (code, )).fetchone()
+			except sqlite3.OperationalError:
+				# this session has no table of this kind
+				row = None
+			d[table] = dict(row) if row is not None else None
+		conn.close()
+		if d["courses"] is not None or d["timetable"] is not None:
+			history.append(d)
+	return history
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser()
+	parser.add_argument("--archive", default=ARCHIVE_DIR,
+		help="Directory holding the archive-capture-<session> directories")
+	parser.add_argument("-s", "--sessions", nargs="*",
+		help="Sessions to look at (ex. 2011-2012 2012-2013). Default is all of them")
+	parser.add_argument("--list", action="store_true",
+		help="List the sessions in the archive")
+	parser.add_argument("--history",
+		help="Show how the given course code was offered in each session")
+	args = parser.parse_args()
+
+	if args.list:
+		for session in list_sessions(args.archive):
+			print(session)
+	elif args.history:
+		for entry in course_history(args.history.upper(), args.sessions, args.archive):
+			pprint(entry)
+	else:
+		print("nothing to do")
@@ -7,6 +7,8 @@
 # 	MODULES			#
 #####################
 
+import gc  # for bounding memory in streaming mode
+import html  # for escaping and unescaping department names
 import logging
 import os
 import pickle as pickler  # for saving inventory...
@@ -19,20 +21,36 @@ import urllib.parse
 import urllib.request  # for downloading web pages
 from argparse import ArgumentParser
 from pprint import pprint
-from typing import List
+from typing import Iterable, Iterator, List, Optional, Set, TextIO, Tuple
 
 import coloredlogs
 from bs4 import BeautifulSoup
 
+from uoft.archive import (DEFAULT_SESSION, SessionMismatchError, add_column_if_missing, check_database_session,
+	check_session, make_session_dir, session_db_path)
+from uoft.changelog import get_row, prune_rows, record_write
+from uoft.course_documents import materialize
+from uoft.course_search import build_search_index
+from uoft.generation import bump_generation
+from uoft.quarantine import Quarantine
+
 #####################
 # 	GLOBAL VARS		#
 #####################
 
 course_code_pattern = r"\w\w\w\d\d\d\w\d"
+# heading that starts the course listing of a department, ex. "Biology Courses"
+department_heading_pattern = r"([^<>.]{1,80}?) Courses"
+# elements that can hold such a heading. Other text ending in "Courses" (ex. a paragraph) is part of a course listing
+department_heading_tags = ["h2", "h3", "h4"]
 pages_dir = "pages"
 DATA_FILE = "calendar_inventory.data"
-DB_PATH = "./data/archive-capture-2012-2013/courses-new.db"
+DB_PATH = session_db_path(DEFAULT_SESSION)
 # DB_PATH = "./courses.db"
+# how much of the page to read at a time in streaming mode
+CHUNK_SIZE = 64 * 1024
+# each BeautifulSoup tree is a reference cycle, so collect them every this many courses in streaming mode
+GC_EVERY = 1000
 
 
 #####################
@@ -76,6 +94,41 @@ def get_functional_soup(all_soup: BeautifulSoup, name: str) -> BeautifulSoup:
 		return BeautifulSoup(bottom_gone, "html.parser")
 
 
+def get_department_soups(all_soup: BeautifulSoup) -> List[Tuple[str, BeautifulSoup]]:
+	"""Like get_functional_soup, but for aggregate pages (ex. Life Sciences) that list the courses of several departments,
+	each under its own "<department> Courses" heading.
+	Return a (department, partial soup) pair for every department section, in page order."""
+
+	heading_re = re.compile(r"^\s*%s\s*$" % department_heading_pattern)
+	headings = [heading for heading in all_soup.find_all(text=heading_re)
+		if heading.parent is not None and heading.parent.name in department_heading_tags]
+	bottom_sep_node = all_soup.find("div", id="footer")
+
+	if len(headings) == 0:
+		raise PageParsingError("Could not find any department Courses headings")
+	elif bottom_sep_node is None:
+		raise PageParsingError("Could not find footer")
+
+	rest = html_str_replace(str(all_soup)).split(str(bottom_sep_node))[0]
+	sections = []
+	department = None # type: Optional[str]
+	# walk down the page once, cutting it at each heading in turn
+	for heading in headings:
+		before, sep, after = rest.partition(str(heading.parent))
+		if sep == "":
+			logging.warning("Could not find heading %s in page", repr(str(heading)))
+			continue
+		if department is not None:
+			sections.append((department, BeautifulSoup(before, "html.parser")))
+		m = heading_re.match(str(heading))
+		assert m is not None
+		department = m.group(1).strip()
+		rest = after
+	assert department is not None
+	sections.append((department, BeautifulSoup(rest, "html.parser")))
+	return sections
+
+
 def get_name(soup: BeautifulSoup) -> str:
 	"""Given the HTML soup for a page, extract the department name and return it.
 	If cannot extract it, return None.
@@ -109,9 +162,17 @@ def get_course_list(soup: BeautifulSoup) -> List[str]:
 	l = re.split(pattern, str(soup))
 	if len(l) == 1:
 		raise PageParsingError("Failed to find course anchors on page")
-	blocks = []
+	return [block for _, block in _join_strong_blocks(("", block) for block in l[1:])]
+
+
+def _join_strong_blocks(blocks: Iterable[Tuple[str, str]]) -> Iterator[Tuple[str, str]]:
+	"""Course anchors are sometimes inside the <strong> holding the course title.
+	Splitting on the anchor leaves the opening tag at the end of the previous block,
+	so move it to the start of the block it belongs to.
+	blocks are (department, course block) pairs."""
+
 	next_block_strong = False
-	for block in l[1:]:
+	for department, block in blocks:
 		block = block.strip()
 		if next_block_strong:
 			# add strong at the beginning
@@ -124,8 +185,94 @@ def get_course_list(soup: BeautifulSoup) -> List[str]:
 		else:
 			next_block_strong = False
 
-		blocks.append(block)
-	return blocks
+		yield department, block
+
+
+def iter_course_blocks(fp: TextIO, chunk_size: int = CHUNK_SIZE, aggregate: bool = False) -> Iterator[Tuple[str, str]]:
+	"""Streaming version of get_name, get_functional_soup (or get_department_soups) and get_course_list.
+	Read the page a chunk at a time and yield each (department, course block) as soon as the next course anchor arrives,
+	so only about one course block is held in memory at once, however large the page is.
+	With aggregate, every "<department> Courses" heading starts a new department section."""
+
+	anchor_pattern = r"<a name=.?%s.?>*?</a>" % course_code_pattern
+	heading_tag_pattern = r"(?i:%s)" % "|".join(department_heading_tags)
+	any_heading_pattern = r"<%s(?:\s[^>]*)?>\s*%s\s*</%s\s*>" % (heading_tag_pattern, department_heading_pattern, heading_tag_pattern)
+	if aggregate:
+		split_re = re.compile(r"((?i:%s))|%s" % (anchor_pattern, any_heading_pattern))
+	else:
+		split_re = re.compile(r"((?i:%s))" % anchor_pattern)
+	footer_re = re.compile(r"<div[^>]*id=.?footer", re.IGNORECASE)
+	h1_re = re.compile(r"<h1[^>]*>(.*?)</h1>", re.IGNORECASE | re.DOTALL)
+
+	buf = ""
+	heading_re = None
+	in_courses = False
+	seen_anchor = False
+	# whether the text being read belongs to a course (as opposed to a section introduction)
+	block_open = False
+	done = False
+
+	while not done:
+		chunk = fp.read(chunk_size)
+		done = (chunk == "")
+		buf += chunk
+
+		if heading_re is None:
+			m = h1_re.search(buf)
+			if m is None:
+				if done:
+					raise PageParsingError("[WARNING] Could not find heading in soup")
+				continue
+			name = BeautifulSoup(m.group(1), "html.parser").text
+			if aggregate:
+				heading_re = re.compile(any_heading_pattern)
+			else:
+				# name is decoded, but the buffer is raw HTML (ex. "Near &amp; Middle Eastern Civilizations")
+				names = {re.escape(name), re.escape(html.escape(name, quote=False))}
+				heading_re = re.compile(r">\s*(%s) Courses\s*</[^>]*>" % "|".join(names))
+			buf = buf[m.end():]
+
+		if not in_courses:
+			m = heading_re.search(buf)
+			if m is None:
+				if done:
+					raise PageParsingError("Could not find %s Courses as heading" % name)
+				# keep enough to match a heading split across chunks
+				buf = buf[-1024:]
+				continue
+			in_courses = True
+			department = html.unescape(m.group(1)).strip()
+			buf = buf[m.end():]
+
+		m = footer_re.search(buf)
+		if m is not None:
+			buf = buf[:m.start()]
+			done = True
+		elif done:
+			raise PageParsingError("Could not find footer")
+
+		m = split_re.search(buf)
+		while m is not None:
+			if block_open:
+				yield department, buf[:m.start()]
+			if m.group(1) is None:
+				# heading of the next department
+				department = html.unescape(m.group(2)).strip()
+				block_open = False
+			else:
+				seen_anchor = True
+				block_open = True
+			buf = buf[m.end():]
+			m = split_re.search(buf)
+
+		if not block_open:
+			# nothing before the first anchor of a section is part of a course
+			buf = buf[-1024:]
+
+	if not seen_anchor:
+		raise PageParsingError("Failed to find course anchors on page")
+	if block_open:
+		yield department, buf
 
 
 def html_str_replace(html_string: str) -> str:
@@ -197,12 +344,17 @@ def make_table(db_path: str) -> tuple:
 	Primary key on course code.
 	"""
 
+	make_session_dir(db_path)
 	conn = sqlite3.connect(db_path)
 	c = conn.cursor()
 	c.execute("""CREATE TABLE IF NOT EXISTS courses
 		(code VARCHAR, name VARCHAR, desc TEXT, Prerequisite VARCHAR, Corequisite VARCHAR, RecommendedPreparation VARCHAR,
-		DistributionRequirementStatus VARCHAR, BreadthRequirement VARCHAR, Exclusion VARCHAR, lectimes VARCHAR,
+		DistributionRequirementStatus VARCHAR, BreadthRequirement VARCHAR, Exclusion VARCHAR, lectimes VARCHAR, session VARCHAR,
+		department VARCHAR,
 		PRIMARY KEY (code))""")
+	# databases captured before sessions and departments were tracked
+	add_column_if_missing(conn, "courses", "session")
+	add_column_if_missing(conn, "courses", "department")
 	conn.commit()
 	return (c, conn)
 
@@ -222,26 +374,32 @@ def confirm_add_to_table(d: dict, c, conn) -> None:
 		confirm_add_to_table(d, c, conn)
 
 
-def add_info_to_table(d: dict, c, conn) -> int:
+def add_info_to_table(d: dict, c, conn, session: Optional[str] = None) -> int:
 	"""Add information in d to the table.
 	Tries to avoid duplicate inserts.
+	Records what changed in the changelog.
 	d is a dict mapping table columns to values.
 	c is a cursor object.
-	conn is a connection object."""
+	conn is a connection object.
+	If session is given, the row is tagged with it."""
 
 	if "code" in d:
 		code = d.pop("code")
+		before = get_row(conn, "courses", code)
 
 		# add the course code first, as primary key
 		c.execute("INSERT OR IGNORE INTO courses (code) VALUES (?)", (code, ))
 
 		# prepare update query
-		keys = list(d.keys()) # do this because d is unordered
+		values = dict(d)
+		if session is not None:
+			values["session"] = session
+		keys = list(values.keys()) # do this because d is unordered
 		placeholder = ", ".join(["%s=?" % k for k in keys]) # placeholder for update values
 		q = "UPDATE courses SET %s WHERE code=?" % (placeholder)
 
 		# execute the update query
-		t = tuple([d[k] for k in keys]) + (code, )
+		t = tuple([values[k] for k in keys]) + (code, )
 
 		try:
 			c.execute(q, t)
@@ -255,6 +413,8 @@ def add_info_to_table(d: dict, c, conn) -> int:
 
 			return 0 # failure
 
+		record_write(conn, "courses", code, before, get_row(conn, "courses", code))
+
 		# re-add code to the dictionary
 		d["code"] = code
 
@@ -263,7 +423,11 @@ def add_info_to_table(d: dict, c, conn) -> int:
 		return 0 # failure
 
 
-def parse_course_page(page_file: str) -> List[dict]:
+def parse_course_page(page_file: str, aggregate: bool = False, quarantine: Optional[Quarantine] = None) -> List[dict]:
+	"""Parse all courses on the page. Each course is tagged with the department it is listed under.
+	With aggregate, the page may list the courses of several departments (see get_department_soups).
+	Courses that fail to parse are added to quarantine, if given."""
+
 	assert page_file is not None
 	soup = None
 	name = None
@@ -271,35 +435,99 @@ def parse_course_page(page_file: str) -> List[dict]:
 		soup = BeautifulSoup(fp.read(), "html.parser")
 		name = get_name(soup)
 		assert name is not None
-	fsoup = get_functional_soup(soup, name)
-	course_list = get_course_list(fsoup)
-	if len(course_list) == 0:
-		print("[WARNING] No courses found on page")
+	if aggregate:
+		sections = get_department_soups(soup)
+	else:
+		sections = [(name, get_functional_soup(soup, name))]
 	courses = []
-	for item in course_list:
+	position = 0 # of the course block on the page
+	for department, fsoup in sections:
 		try:
-			course = get_course_info(item)
-			courses.append(course)
-		except CourseParsingError as e:
-			logging.warning("Failed to parse course in file: %s", page_file)
-			logging.warning(e)
+			course_list = get_course_list(fsoup)
+		except PageParsingError:
+			if not aggregate:
+				raise
+			logging.warning("No courses found for department %s in file: %s", department, page_file)
+			continue
+		if len(course_list) == 0:
+			print("[WARNING] No courses found on page")
+		for item in course_list:
+			try:
+				course = get_course_info(item)
+				course["department"] = department
+				courses.append(course)
+			except CourseParsingError as e:
+				logging.warning("Failed to parse course in file: %s", page_file)
+				logging.warning(e)
+				if quarantine is not None:
+					quarantine.add("course", page_file, e, item, position, department)
+			position += 1
 	return courses
 
 
-def insert_courses_into_db(courses: List[dict], source_file: str, db_path: str) -> int:
+def iter_course_page(page_file: str, chunk_size: int = CHUNK_SIZE, aggregate: bool = False,
+		quarantine: Optional[Quarantine] = None) -> Iterator[dict]:
+	"""Streaming version of parse_course_page. Yield one course at a time,
+	using constant memory regardless of the size of the page."""
+
+	assert page_file is not None
+	with open(page_file) as fp:
+		for i, (department, item) in enumerate(_join_strong_blocks(iter_course_blocks(fp, chunk_size, aggregate))):
+			if i % GC_EVERY == GC_EVERY - 1:
+				gc.collect()
+			try:
+				course = get_course_info(item)
+				course["department"] = department
+				yield course
+			except CourseParsingError as e:
+				logging.warning("Failed to parse course in file: %s", page_file)
+				logging.warning(e)
+				if quarantine is not None:
+					quarantine.add("course", page_file, e, item, i, department)
+
+
+def dedupe_courses(courses: Iterable[dict], seen: Set[str]) -> Iterator[dict]:
+	"""Drop courses whose code is in seen, and add the codes of the others to it.
+	Share seen between pages so a course listed on several pages is only kept the first time."""
+
+	for d in courses:
+		code = d.get("code")
+		if code in seen:
+			logging.debug("Skipping duplicate course %s", code)
+			continue
+		if code is not None:
+			seen.add(code)
+		yield d
+
+
+def insert_courses_into_db(courses: Iterable[dict], source_file: str, db_path: str, session: str = DEFAULT_SESSION) -> int:
+	"""Write the courses to the database. Return the number of inserts made.
+	Raises SessionMismatchError if the database holds the courses of another session."""
+
 	# create/open the SQL DB
 	c, conn = make_table(db_path)
 
 	num_inserts = 0 # keep track of the number of inserts made
 
-	for d in courses:
-		if "code" in d and "name" in d:
-			# add gathered information into the table, if enough info gathered
-			num_inserts += add_info_to_table(d, c, conn)
-		else:
-			logging.warning("Found a course without a name or course code. File: %s", source_file)
-			logging.warning("Course was %s", str(d))
-
+	try:
+		check_session(conn, "courses", session)
+		for d in courses:
+			if "code" in d and "name" in d:
+				# add gathered information into the table, if enough info gathered
+				num_inserts += add_info_to_table(d, c, conn, session)
+			else:
+				logging.warning("Found a course without a name or course code. File: %s", source_file)
+				logging.warning("Course was %s", str(d))
+	except Exception:
+		# courses can be a stream that fails part way through the page.
+		# Drop its partial writes and release the database, so the page can be quarantined and retried as a whole
+		conn.rollback()
+		c.close()
+		conn.close()
+		raise
+
+	if num_inserts > 0:
+		bump_generation(conn)
 	conn.commit() # push all changes
 	c.close() # get rid of the cursor
 	return num_inserts
@@ -364,9 +592,18 @@ def get_course_files(dir: str) -> List[str]:
 	return l
 
 
-def print_or_write(courses: List[dict], db_path: str, source_file: str, output: str = "stdout"):
+def page_title(path: str) -> str:
+	"""Return the title of a saved calendar page from its file name, whatever the session or directory.
+	ex. "Life Sciences" for data/archive-capture-2012-2013/calendar-files/2012-2013 Calendar - Life Sciences.htm"""
+
+	name = os.path.splitext(os.path.basename(path))[0]
+	return re.sub(r"^.*? Calendar - ", "", name)
+
+
+def print_or_write(courses: Iterable[dict], db_path: str, source_file: str, output: str = "stdout",
+		session: str = DEFAULT_SESSION):
 	if output == "database":
-		num_inserts = insert_courses_into_db(courses, source_file, db_path)
+		num_inserts = insert_courses_into_db(courses, source_file, db_path, session)
 		print("Parsed file %s. Wrote %d new courses to database" % (source_file, num_inserts))
 	else:
 		for course in courses:
@@ -375,8 +612,10 @@ def print_or_write(courses: List[dict], db_path: str, source_file: str, output:
 
 if __name__ == "__main__":
 	parser = ArgumentParser()
-	parser.add_argument("--database", default=DB_PATH,
-		help="path to SQLite file to use")
+	parser.add_argument("--session", default=DEFAULT_SESSION,
+		help="Session the pages were captured from (ex. 2012-2013). Default is %s" % DEFAULT_SESSION)
+	parser.add_argument("--database",
+		help="path to SQLite file to use. Default is the archive database for the session")
 	parser.add_argument("-f", "--file",
 		help="File to parse")
 	parser.add_argument("-d", "--dir",
@@ -384,6 +623,14 @@ if __name__ == "__main__":
 	parser.add_argument("-o", "--output", default="stdout",
 		choices=["stdout", "database"],
 		help="Where to output the parsed file. Default is stdout")
+	parser.add_argument("--stream", action="store_true",
+		help="Read pages incrementally and handle one course at a time. Use this for very large pages")
+	parser.add_argument("--aggregate", action="store_true",
+		help="The file lists courses of several departments, each under its own Courses heading")
+	parser.add_argument("--prune", action="store_true",
+		help="With --dir and database output, delete courses that weren't found on any page")
+	parser.add_argument("--retry-quarantine", action="store_true",
+		help="With database output, parse only the pages and courses that failed before (see uoft/quarantine.py)")
 	parser.add_argument("-v", "--verbose", action="store_true",
 		help="Use this flag for verbose output")
 	args = parser.parse_args()
@@ -392,41 +639,122 @@ if __name__ == "__main__":
 	logging.basicConfig(level=log_level)
 	coloredlogs.install(log_level)
 
-	if args.file:
+	if args.database is None:
+		args.database = session_db_path(args.session)
+	elif args.output == "database":
+		try:
+			check_database_session(args.database, "courses", args.session)
+		except SessionMismatchError as e:
+			parser.error(str(e))
+
+	parse_page = (iter_course_page if args.stream else parse_course_page)
+	# pages are matched by title (see page_title)
+	blacklist = frozenset([
+		# no courses on this page
+		"199299398399",
+		# no courses on this page
+		"Writing in the Faculty of Arts & Science",
+	])
+	# these are aggregations of courses by a few different departments
+	aggregate_pages = frozenset([
+		"Life Sciences",
+		"Joint Courses",
+		"Modern Languages and Literatures",
+		"Biology",
+	])
+	# failures are only quarantined when writing to the database
+	quarantine = (Quarantine(args.database, "calendar") if args.output == "database" else None)
+
+	def parse_and_write(path: str, aggregate: bool, seen: Optional[Set[str]] = None) -> bool:
+		"""Parse the page and output its courses. Return False if the page couldn't be parsed,
+		in which case it is quarantined (when writing to the database) and the run carries on."""
+
+		if quarantine is not None:
+			quarantine.resolve_source(path)
 		try:
-			assert args.file is not None
-			courses = parse_course_page(args.file)
-			print_or_write(courses, args.database, args.file, args.output)
-		except PageParsingError as e:
-			logging.error("Failed to parse file %s", args.file)
+			courses = parse_page(path, aggregate=aggregate, quarantine=quarantine) # type: Iterable[dict]
+			if seen is not None:
+				courses = dedupe_courses(courses, seen)
+			print_or_write(courses, args.database, path, args.output, args.session)
+			return True
+		except Exception as e:
+			logging.error("Failed to parse file: %s", path)
 			logging.error(e)
+			if quarantine is not None:
+				quarantine.add("page", path, e)
+			return False
+		finally:
+			if quarantine is not None:
+				quarantine.flush()
+
+	if args.retry_quarantine:
+		if quarantine is None:
+			parser.error("--retry-quarantine needs --output database")
+		items = quarantine.pending()
+		# pages that failed as a whole are parsed again, which also covers any of their courses
+		retry_pages = sorted(set(item["source"] for item in items if item["kind"] == "page"))
+		courses = []
+		retried = {} # type: dict
+		for item in items:
+			if item["kind"] != "course" or item["source"] in retry_pages:
+				continue
+			try:
+				course = get_course_info(item["snippet"])
+				course["department"] = item["department"]
+				courses.append(course)
+				retried.setdefault(item["source"], []).append((item["id"], course))
+			except CourseParsingError as e:
+				quarantine.discard(item["id"])
+				quarantine.add("course", item["source"], e, item["snippet"], item["position"], item["department"])
+		quarantine.flush()
+		for source, retried_courses in retried.items():
+			print_or_write([course for _, course in retried_courses], args.database, source, args.output, args.session)
+			quarantine.resolve([item_id for item_id, _ in retried_courses])
+		for path in retry_pages:
+			parse_and_write(path, page_title(path) in aggregate_pages)
+		print("Retried %d quarantined items. %d are still quarantined" % (len(items), len(quarantine.pending())))
+	elif args.file:
+		assert args.file is not None
+		if not parse_and_write(args.file, args.aggregate):
 			sys.exit(1)
 	elif args.dir:
-		blacklist = frozenset([
-			# this is an aggregation of courses by a few different departments
-			"data/archive-capture-2012-2013/calendar-files/2012-2013 Calendar - Life Sciences.htm",
-			# no courses on this page
-			"data/archive-capture-2012-2013/calendar-files/2012-2013 Calendar - 199299398399.htm",
-			# this is an aggregation of courses by a few different departments
-			"data/archive-capture-2012-2013/calendar-files/2012-2013 Calendar - Joint Courses.htm",
-			# no courses on this page
-			"data/archive-capture-2012-2013/calendar-files/2012-2013 Calendar - Writing in the Faculty of Arts & Science.htm",
-			# this is an aggregation of courses by a few different departments
-			"data/archive-capture-2012-2013/calendar-files/2012-2013 Calendar - Modern Languages and Literatures.htm",
-			# this is an aggregation of courses by a few different departments
-			"data/archive-capture-2012-2013/calendar-files/2012-2013 Calendar - Biology.htm",
-		])
-		for path in get_course_files(args.dir):
-			if path in blacklist:
+		# courses seen so far in this run, so courses listed on several pages are only written once
+		seen = set() # type: Set[str]
+		# do department pages first, so their version of a course wins over the aggregate pages
+		paths = sorted(get_course_files(args.dir), key=lambda path: page_title(path) in aggregate_pages)
+		failed = []
+		for path in paths:
+			if page_title(path) in blacklist:
 				logging.debug("Skipping blacklisted file: %s", path)
 				continue
-			try:
-				courses = parse_course_page(path)
-				print_or_write(courses, args.database, path, args.output)
-			except PageParsingError as e:
-				logging.error("Failed to parse file: %s", path)
-				logging.error(e)
-				sys.exit(1)
+			if not parse_and_write(path, page_title(path) in aggregate_pages, seen):
+				failed.append(path)
+		if len(failed) > 0:
+			print("Failed to parse %d files. Fix the parser and rerun with --retry-quarantine" % len(failed))
+		if args.prune and args.output == "database":
+			assert quarantine is not None
+			if quarantine.num_added > 0:
+				# the courses on the failed pages and the quarantined courses weren't seen, but are still in the calendar
+				logging.warning("Not pruning, since some files or courses failed to parse")
+			else:
+				c, conn = make_table(args.database)
+				num_deletes = prune_rows(conn, "courses", seen)
+				if num_deletes > 0:
+					bump_generation(conn)
+				conn.commit()
+				c.close()
+				print("Deleted %d courses that are no longer in the calendar" % num_deletes)
 	else:
 		print("nothing to do")
 
+	if quarantine is not None:
+		quarantine.close()
+
+	if args.output == "database" and (args.file or args.dir or args.retry_quarantine):
+		# bring the joined per-course documents and the lookup index up to date with what was just written
+		conn = sqlite3.connect(args.database)
+		n = materialize(conn)
+		print("Rebuilt %d course documents" % n)
+		if n > 0:
+			print("Indexed %d courses for lookup" % build_search_index(conn))
+		conn.close()
@@ -0,0 +1,163 @@
+#############################################
+#	CHANGE FEED OF CATALOGUE UPDATES		#
+#############################################
+
+"""The writers (add_info_to_table and the timetable parser's write_to_db) record every row they insert or change,
+and every row pruned by a full ingest, in an append-only changelog table.
+The timetable table only keeps one section per offering, so changes to the sections of an offering are also
+recorded, against timetable_sections.
+Each entry gets a sequence number that only ever goes up, so a consumer can remember the last
+number it saw and ask for everything after it instead of diffing full dumps."""
+
+#####################
+# 	MODULES			#
+#####################
+
+import json
+import logging
+import sqlite3
+import sys
+from argparse import ArgumentParser
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+
+from uoft.archive import DEFAULT_SESSION, session_db_path
+
+#####################
+# 	GLOBAL VARS		#
+#####################
+
+logger = logging.getLogger(__name__)
+
+# session only says which archive a row was written for, so it isn't a change to the catalogue
+IGNORED_FIELDS = frozenset(["session"])
+
+#####################
+# 	CODE			#
+#####################
+
+
+def make_changelog_table(conn: sqlite3.Connection) -> None:
+	"""Create the changelog table if it doesn't exist.
+	AUTOINCREMENT makes sure sequence numbers are never reused, even after the newest entries are deleted."""
+
+	conn.execute("""CREATE TABLE IF NOT EXISTS changelog
+		(seq INTEGER PRIMARY KEY AUTOINCREMENT, tbl VARCHAR NOT NULL, code VARCHAR NOT NULL, op VARCHAR NOT NULL,
+		changes TEXT, recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+
+
+def get_row(conn: sqlite3.Connection, table: str, code: str) -> Optional[dict]:
+	"""Return the row for the code as a dictionary, or None if there isn't one."""
+
+	cur = conn.execute("SELECT * FROM %s WHERE code=?" % table, (code, ))
+	row = cur.fetchone()
+	if row is None:
+		return None
+	return dict(zip([col[0] for col in cur.description], row))
+
+
+def record_write(conn: sqlite3.Connection, table: str, code: str, before: Optional[dict], after: Optional[dict]) -> None:
+	"""Record the difference between a row before and after a write.
+	changes maps each changed field to its [old, new] values. Writes that change nothing aren't recorded."""
+
+	if after is None:
+		return
+	before = before or {}
+	changes = {}
+	for field, value in after.items():
+		if field in IGNORED_FIELDS or field == "code":
+			continue
+		if before.get(field) != value:
+			changes[field] = [before.get(field), value]
+
+	if len(before) == 0:
+		op = "insert"
+	elif len(changes) > 0:
+		op = "update"
+	else:
+		return
+
+	make_changelog_table(conn)
+	conn.execute("INSERT INTO changelog (tbl, code, op, changes) VALUES (?, ?, ?, ?)",
+		(table, code, op, json.dumps(changes)))
+
+
+def record_sections_write(conn: sqlite3.Connection, code: str, before: Dict[str, dict], after: Dict[str, dict]) -> None:
+	"""Record the sections of an offering that were added, changed or removed by a write.
+	before and after map each section (ex. "L0101") to its columns, and changes maps each changed section
+	to its [old, new] columns, None for a section that doesn't exist."""
+
+	if before == after:
+		return
+	sections = list(after) + [section for section in before if section not in after]
+	record_write(conn, "timetable_sections", code,
+		{section: before.get(section) for section in sections} if len(before) > 0 else None,
+		{section: after.get(section) for section in sections})
+
+
+def prune_rows(conn: sqlite3.Connection, table: str, keep: Set[str]) -> int:
+	"""Delete every row whose code isn't in keep, recording the deleted values.
+	Use after a full ingest of a session, with keep being all the codes that were seen.
+	Return the number of rows deleted."""
+
+	make_changelog_table(conn)
+	codes = [row[0] for row in conn.execute("SELECT code FROM %s" % table)]
+	n = 0
+	for code in codes:
+		if code in keep:
+			continue
+		before = get_row(conn, table, code) or {}
+		changes = {field: [value, None] for field, value in before.items()
+			if field not in IGNORED_FIELDS and field != "code" and value is not None}
+		conn.execute("DELETE FROM %s WHERE code=?" % table, (code, ))
+		conn.execute("INSERT INTO changelog (tbl, code, op, changes) VALUES (?, ?, ?, ?)",
+			(table, code, "delete", json.dumps(changes)))
+		n += 1
+	return n
+
+
+def track_codes(rows: Iterable[dict], seen: Set[str]) -> Iterator[dict]:
+	"""Pass rows through, adding their codes to seen. Feed seen to prune_rows at the end of a full ingest."""
+
+	for row in rows:
+		if "code" in row:
+			seen.add(row["code"])
+		yield row
+
+
+def changes_since(conn: sqlite3.Connection, seq: int = 0, limit: Optional[int] = None) -> List[dict]:
+	"""Return changelog entries with a sequence number greater than seq, oldest first."""
+
+	make_changelog_table(conn)
+	q = "SELECT seq, tbl, code, op, changes, recorded_at FROM changelog WHERE seq > ? ORDER BY seq"
+	args = (seq, ) # type: tuple
+	if limit is not None:
+		q += " LIMIT ?"
+		args += (limit, )
+	return [{"seq": s, "table": tbl, "code": code, "op": op, "changes": json.loads(changes), "recorded_at": recorded_at}
+		for s, tbl, code, op, changes, recorded_at in conn.execute(q, args)]
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser()
+	parser.add_argument("--session", default=DEFAULT_SESSION,
+		help="Session to read changes for (ex. 2012-2013). Default is %s" % DEFAULT_SESSION)
+	parser.add_argument("--database",
+		help="Path to SQLite database. Default is the archive database for the session")
+	parser.add_argument("-s", "--since", type=int, default=0,
+		help="Only export changes after this sequence number")
+	parser.add_argument("-n", "--limit", type=int,
+		help="Export at most this many changes")
+	parser.add_argument("-o", "--output",
+		help="File to write the changes to, one JSON object per line. Default is stdout")
+	args = parser.parse_args()
+
+	if args.database is None:
+		args.database = session_db_path(args.session)
+
+	conn = sqlite3.connect(args.database)
+	out = open(args.output, "w") if args.output else sys.stdout
+	for change in changes_since(conn, args.since, args.limit):
+		out.write(json.dumps(change) + "\n")
+	if args.output:
+		out.close()
+	conn.close()
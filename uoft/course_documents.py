@@ -0,0 +1,166 @@
+#############################################
+#	PER-COURSE JSON DOCUMENTS				#
+#############################################
+
+"""After an ingest, join each course's calendar entry with all of its timetable sections into one
+JSON document, and store it pre-compressed so the server can send it as is.
+Only courses with entries in the changelog since the last build are rebuilt."""
+
+#####################
+# 	MODULES			#
+#####################
+
+import gzip
+import json
+import logging
+import sqlite3
+from argparse import ArgumentParser
+from typing import List, Optional, Set
+
+from uoft.archive import DEFAULT_SESSION, session_db_path
+from uoft.changelog import changes_since, get_row, make_changelog_table
+from uoft.schedule_query import get_sections, parse_meetings
+
+try:
+	import brotli
+except ImportError:
+	# brotli is optional, without it documents are only pre-compressed with gzip
+	brotli = None
+
+#####################
+# 	GLOBAL VARS		#
+#####################
+
+logger = logging.getLogger(__name__)
+
+# these are bookkeeping, not part of the course
+HIDDEN_FIELDS = frozenset(["session"])
+
+#####################
+# 	CODE			#
+#####################
+
+
+def make_document_tables(conn: sqlite3.Connection) -> None:
+	"""Create the document tables if they don't exist.
+	course_documents_bulk is a single row holding every document in one array,
+	and the changelog sequence number the documents are up to date with."""
+
+	conn.execute("""CREATE TABLE IF NOT EXISTS course_documents
+		(code VARCHAR PRIMARY KEY, doc TEXT, gzip BLOB, br BLOB, built_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+	conn.execute("""CREATE TABLE IF NOT EXISTS course_documents_bulk
+		(id INTEGER PRIMARY KEY CHECK (id = 0), last_seq INTEGER, gzip BLOB, br BLOB)""")
+
+
+def _minutes_to_str(minutes: int) -> str:
+	return "%d:%02d" % (minutes // 60, minutes % 60)
+
+
+def _has_table(conn: sqlite3.Connection, table: str) -> bool:
+	return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table, )).fetchone() is not None
+
+
+def _get_sections(conn: sqlite3.Connection, code: str, offering: Optional[dict]) -> List[dict]:
+	"""Return every section of the offering with its own columns, from the index the timetable parser keeps.
+	Databases written before the index existed only have the one section kept in the timetable table."""
+
+	if _has_table(conn, "timetable_sections"):
+		sections = get_sections(conn, code)
+		if len(sections) > 0:
+			return [dict({"section": section or None}, **columns) for section, columns in sections.items()]
+	if offering is None:
+		return []
+	return [{k: v for k, v in offering.items() if k not in HIDDEN_FIELDS and k not in ("code", "name")}]
+
+
+def build_document(conn: sqlite3.Connection, code: str) -> Optional[dict]:
+	"""Join the calendar entry and timetable sections of a course.
+	Return None if the course is in neither table."""
+
+	course = get_row(conn, "courses", code) if _has_table(conn, "courses") else None
+	offering = get_row(conn, "timetable", code) if _has_table(conn, "timetable") else None
+
+	if course is None and offering is None:
+		return None
+
+	doc = {"code": code} # type: dict
+	if course is not None:
+		doc.update({k: v for k, v in course.items() if k not in HIDDEN_FIELDS})
+	elif offering is not None and offering.get("name"):
+		doc["name"] = offering["name"]
+
+	doc["sections"] = _get_sections(conn, code, offering)
+	for section in doc["sections"]:
+		section["meetings"] = [{"days": days, "start": _minutes_to_str(start), "end": _minutes_to_str(end)}
+			for days, start, end in parse_meetings(section.get("time"))]
+	return doc
+
+
+def _compress(data: bytes) -> tuple:
+	return (gzip.compress(data), brotli.compress(data) if brotli is not None else None)
+
+
+def _all_codes(conn: sqlite3.Connection) -> Set[str]:
+	codes = set() # type: Set[str]
+	for table in ["courses", "timetable"]:
+		if _has_table(conn, table):
+			codes.update(row[0] for row in conn.execute("SELECT code FROM %s" % table))
+	return codes
+
+
+def materialize(conn: sqlite3.Connection, full: bool = False) -> int:
+	"""Bring the course documents up to date with the courses and timetable tables.
+	Only courses changed since the last build are rebuilt, unless full is set or nothing was built yet.
+	Return the number of documents rebuilt or removed."""
+
+	make_document_tables(conn)
+	make_changelog_table(conn)
+	state = conn.execute("SELECT last_seq FROM course_documents_bulk WHERE id = 0").fetchone()
+	# read this first, so changes made while building are picked up next time
+	new_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changelog").fetchone()[0]
+
+	if full or state is None:
+		conn.execute("DELETE FROM course_documents")
+		codes = _all_codes(conn)
+	else:
+		codes = set(change["code"] for change in changes_since(conn, state[0]))
+
+	for code in codes:
+		doc = build_document(conn, code)
+		if doc is None:
+			conn.execute("DELETE FROM course_documents WHERE code=?", (code, ))
+			continue
+		doc_json = json.dumps(doc)
+		gz, br = _compress(doc_json.encode("utf-8"))
+		conn.execute("INSERT OR REPLACE INTO course_documents (code, doc, gzip, br) VALUES (?, ?, ?, ?)",
+			(code, doc_json, gz, br))
+
+	if len(codes) > 0 or state is None:
+		docs = [row[0] for row in conn.execute("SELECT doc FROM course_documents ORDER BY code")]
+		gz, br = _compress(("[" + ",".join(docs) + "]").encode("utf-8"))
+		conn.execute("INSERT OR REPLACE INTO course_documents_bulk (id, last_seq, gzip, br) VALUES (0, ?, ?, ?)",
+			(new_seq, gz, br))
+	else:
+		conn.execute("UPDATE course_documents_bulk SET last_seq=? WHERE id = 0", (new_seq, ))
+
+	conn.commit()
+	return len(codes)
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser()
+	parser.add_argument("--session", default=DEFAULT_SESSION,
+		help="Session to build documents for (ex. 2012-2013). Default is %s" % DEFAULT_SESSION)
+	parser.add_argument("--database",
+		help="Path to SQLite database. Default is the archive database for the session")
+	parser.add_argument("--full", action="store_true",
+		help="Rebuild every document, not just the ones for changed courses")
+	args = parser.parse_args()
+
+	if args.database is None:
+		args.database = session_db_path(args.session)
+
+	conn = sqlite3.connect(args.database)
+	n = materialize(conn, args.full)
+	print("Rebuilt %d course documents" % n)
+	conn.close()
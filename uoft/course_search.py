@@ -0,0 +1,211 @@
+#############################################
+#	FUZZY COURSE CODE AND TITLE LOOKUP		#
+#############################################
+
+"""Typo-tolerant lookup over course codes and names.
+Ingest writes a trigram index (course_trigrams) over each course's code and name.
+CourseSearch loads it into memory and ranks courses by how many of the query's trigrams they share,
+after trying the query as a (possibly partial) course code such as "csc 108" or "CSC108H"."""
+
+#####################
+# 	MODULES			#
+#####################
+
+import heapq
+import logging
+import re
+import sqlite3
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from itertools import chain
+from typing import Dict, Iterator, List, Set, Tuple
+
+from uoft.archive import DEFAULT_SESSION, session_db_path
+from uoft.generation import bump_generation
+
+#####################
+# 	GLOBAL VARS		#
+#####################
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 10
+# a query that looks like the start of a course code, with or without the campus suffix (H1/Y1)
+code_prefix_pattern = re.compile(r"^[A-Z]{3}(\d{1,3}([HY](\d)?)?)?$")
+
+#####################
+# 	CODE			#
+#####################
+
+
+def normalize_text(s: str) -> str:
+	"""Lowercase, and turn anything that isn't a letter or digit into single spaces."""
+
+	return " ".join(re.sub(r"[^a-z0-9]+", " ", s.lower()).split())
+
+
+def normalize_code(s: str) -> str:
+	"""Course code variants ("csc 108", "Csc-108h1") become the form used in the tables ("CSC108H1")."""
+
+	return re.sub(r"[^A-Za-z0-9]", "", s).upper()
+
+
+def trigrams(s: str) -> Set[str]:
+	"""Trigrams of each word of the normalized text, padded so the start of a word counts more."""
+
+	grams = set() # type: Set[str]
+	for word in normalize_text(s).split():
+		padded = "  %s " % word
+		for i in range(len(padded) - 2):
+			grams.add(padded[i:i + 3])
+	return grams
+
+
+def make_trigram_table(conn: sqlite3.Connection) -> None:
+	conn.execute("""CREATE TABLE IF NOT EXISTS course_trigrams
+		(trigram CHAR(3), code VARCHAR, PRIMARY KEY (trigram, code)) WITHOUT ROWID""")
+
+
+def _course_names(conn: sqlite3.Connection) -> Dict[str, str]:
+	"""Map from code to name, from the calendar where there is one, otherwise the timetable."""
+
+	names = {} # type: Dict[str, str]
+	for table in ["timetable", "courses"]:
+		if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table, )).fetchone():
+			for code, name in conn.execute("SELECT code, name FROM %s" % table):
+				if code and name:
+					names[code] = name
+	return names
+
+
+def build_search_index(conn: sqlite3.Connection) -> int:
+	"""Rebuild the trigram index over every course's code and name, and bump the generation so the
+	server reloads its copy. Return the number of courses indexed."""
+
+	make_trigram_table(conn)
+	conn.execute("DELETE FROM course_trigrams")
+	names = _course_names(conn)
+	for code, name in names.items():
+		grams = trigrams(code) | trigrams(name)
+		conn.executemany("INSERT OR IGNORE INTO course_trigrams (trigram, code) VALUES (?, ?)",
+			[(gram, code) for gram in grams])
+	bump_generation(conn)
+	conn.commit()
+	return len(names)
+
+
+class CourseSearch:
+	'''In-memory copy of the trigram index, for per-keystroke lookups.'''
+
+	def __init__(self, conn: sqlite3.Connection):
+		make_trigram_table(conn)
+		self.names = _course_names(conn)
+		# trigram -> codes of courses that have it
+		self.postings = {} # type: Dict[str, List[str]]
+		# code -> number of trigrams the course has
+		self.sizes = {} # type: Dict[str, int]
+		for gram, code in conn.execute("SELECT trigram, code FROM course_trigrams"):
+			self.postings.setdefault(gram, []).append(code)
+			self.sizes[code] = self.sizes.get(code, 0) + 1
+		self.codes = sorted(self.sizes.keys())
+
+	def _code_matches(self, prefix: str) -> List[str]:
+		"""Codes starting with prefix, using binary search over the sorted codes."""
+
+		lo, hi = 0, len(self.codes)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.codes[mid] < prefix:
+				lo = mid + 1
+			else:
+				hi = mid
+		matches = []
+		while lo < len(self.codes) and self.codes[lo].startswith(prefix):
+			matches.append(self.codes[lo])
+			lo += 1
+		return matches
+
+	def search(self, query: str, limit: int = DEFAULT_LIMIT) -> List[dict]:
+		"""Return up to limit courses matching the query, best first.
+		Courses whose code starts with the query (ignoring spaces and case) come first.
+		The rest are ranked by the fraction of the query's trigrams they share, then by overall similarity."""
+
+		results = [] # type: List[dict]
+		seen = set() # type: Set[str]
+
+		code = normalize_code(query)
+		if code and code_prefix_pattern.match(code):
+			for match in self._code_matches(code)[:limit]:
+				results.append({"code": match, "name": self.names.get(match), "score": 1.0})
+				seen.add(match)
+		if len(results) >= limit:
+			return results
+
+		grams = trigrams(query)
+		if len(grams) == 0:
+			return results
+		# Counter does the counting in C, which matters for short queries with long posting lists
+		shared = Counter(chain.from_iterable(self.postings.get(gram, ()) for gram in grams))
+
+		ranked: Iterator[Tuple[float, float, str]] = ((-n / len(grams), -n / (len(grams) + self.sizes[match] - n), match)
+			for match, n in shared.items() if match not in seen)
+		for neg_coverage, _, match in heapq.nsmallest(limit - len(results), ranked):
+			results.append({"code": match, "name": self.names.get(match), "score": round(-neg_coverage, 3)})
+		return results
+
+
+def benchmark(search: CourseSearch, queries: List[str]) -> Dict[str, float]:
+	"""Time a lookup for every prefix of every query, as if typed one key at a time.
+	Return the mean, 99th percentile and max latency in milliseconds."""
+
+	timings = []
+	for query in queries:
+		for i in range(1, len(query) + 1):
+			start = time.perf_counter()
+			search.search(query[:i])
+			timings.append((time.perf_counter() - start) * 1000)
+	timings.sort()
+	return {
+		"keystrokes": len(timings),
+		"mean_ms": sum(timings) / len(timings),
+		"p99_ms": timings[min(len(timings) - 1, int(len(timings) * 0.99))],
+		"max_ms": timings[-1],
+	}
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser()
+	parser.add_argument("--session", default=DEFAULT_SESSION,
+		help="Session to search (ex. 2012-2013). Default is %s" % DEFAULT_SESSION)
+	parser.add_argument("--database",
+		help="Path to SQLite database. Default is the archive database for the session")
+	parser.add_argument("query", nargs="*",
+		help="Course code or title to look up")
+	parser.add_argument("-n", "--limit", type=int, default=DEFAULT_LIMIT)
+	parser.add_argument("--rebuild-index", action="store_true",
+		help="Rebuild the trigram index first")
+	parser.add_argument("--benchmark", action="store_true",
+		help="Time lookups for every prefix of the queries (or a built-in set), as if typed")
+	args = parser.parse_args()
+
+	if args.database is None:
+		args.database = session_db_path(args.session)
+
+	conn = sqlite3.connect(args.database)
+	if args.rebuild_index:
+		print("Indexed %d courses" % build_search_index(conn))
+	search = CourseSearch(conn)
+	conn.close()
+
+	if args.benchmark:
+		queries = [" ".join(args.query)] if args.query else [
+			"csc 108", "CSC148H1", "intro programming", "introdction to psycology", "mat137y", "organic chemistry"]
+		stats = benchmark(search, queries)
+		print("%d keystrokes: mean %.3f ms, p99 %.3f ms, max %.3f ms" % (
+			stats["keystrokes"], stats["mean_ms"], stats["p99_ms"], stats["max_ms"]))
+	elif args.query:
+		for result in search.search(" ".join(args.query), args.limit):
+			print("%s\t%.3f\t%s" % (result["code"], result["score"], result["name"]))
+	elif not args.rebuild_index:
+		print("nothing to do")
@@ -0,0 +1,40 @@
+#############################################
+#	INGEST GENERATION COUNTER				#
+#############################################
+
+"""Every ingest that commits new rows bumps a single counter in the database.
+Readers (ex. the server's query cache) compare it to the generation they computed
+their results against, and throw away anything older."""
+
+#####################
+# 	MODULES			#
+#####################
+
+import sqlite3
+
+#####################
+# 	CODE			#
+#####################
+
+
+def make_generation_table(conn: sqlite3.Connection) -> None:
+	"""Create the single-row generation table if it doesn't exist."""
+
+	conn.execute("""CREATE TABLE IF NOT EXISTS ingest_generation
+		(id INTEGER PRIMARY KEY CHECK (id = 0), generation INTEGER NOT NULL)""")
+	conn.execute("INSERT OR IGNORE INTO ingest_generation (id, generation) VALUES (0, 0)")
+
+
+def get_generation(conn: sqlite3.Connection) -> int:
+	make_generation_table(conn)
+	return conn.execute("SELECT generation FROM ingest_generation WHERE id = 0").fetchone()[0]
+
+
+def bump_generation(conn: sqlite3.Connection) -> int:
+	"""Increment the generation. Call this right before committing an ingest,
+	so the new rows and the new generation become visible together.
+	Return the new generation."""
+
+	make_generation_table(conn)
+	conn.execute("UPDATE ingest_generation SET generation = generation + 1 WHERE id = 0")
+	return get_generation(conn)
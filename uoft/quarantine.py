@@ -0,0 +1,173 @@
+#############################################
+#	QUARANTINE OF PARSE FAILURES			#
+#############################################
+
+"""Pages and course blocks the parsers fail on are recorded in a quarantine table instead of aborting
+the run or being dropped with a warning. Each entry keeps the source file, the position of the block on
+the page, the error and the raw HTML, so that after a parser fix only the quarantined items need to be
+parsed again (see --retry-quarantine in the parsers)."""
+
+#####################
+# 	MODULES			#
+#####################
+
+import logging
+import sqlite3
+from argparse import ArgumentParser
+from typing import Iterable, List, Optional, Union
+
+from uoft.archive import DEFAULT_SESSION, make_session_dir, session_db_path
+
+#####################
+# 	GLOBAL VARS		#
+#####################
+
+logger = logging.getLogger(__name__)
+
+# how much of a page to keep when the whole page failed
+PAGE_SNIPPET_CHARS = 4096
+
+#####################
+# 	CODE			#
+#####################
+
+
+def make_quarantine_table(conn: sqlite3.Connection) -> None:
+	"""Create the quarantine table if it doesn't exist.
+	kind is "page" when nothing could be parsed from the page, otherwise the kind of block (ex. "course", "row").
+	position counts blocks from the start of the page. Items are pending until resolved_at is set."""
+
+	conn.execute("""CREATE TABLE IF NOT EXISTS quarantine
+		(id INTEGER PRIMARY KEY AUTOINCREMENT, parser VARCHAR NOT NULL, kind VARCHAR NOT NULL, source VARCHAR NOT NULL,
+		position INTEGER, department VARCHAR, error TEXT, snippet TEXT,
+		recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, resolved_at TIMESTAMP)""")
+
+
+def read_snippet(path: str, n: int = PAGE_SNIPPET_CHARS) -> Optional[str]:
+	"""Return the start of the file, or None if it can't be read."""
+
+	try:
+		with open(path, errors="replace") as fp:
+			return fp.read(n)
+	except OSError:
+		return None
+
+
+def format_error(error: Union[str, Exception]) -> str:
+	if isinstance(error, Exception):
+		return "%s: %s" % (type(error).__name__, error)
+	return error
+
+
+class Quarantine:
+	'''Records the parse failures of one parser in the quarantine table of a database.
+	New items are buffered until flush, since the parsers' writers may hold a transaction open on the same
+	database while parsing; call flush once the page has been written.'''
+
+	def __init__(self, db_path: str, parser: str):
+		self.parser = parser
+		make_session_dir(db_path)
+		self.conn = sqlite3.connect(db_path)
+		make_quarantine_table(self.conn)
+		self.conn.commit()
+		self._buffer = [] # type: List[tuple]
+		# items quarantined through this object, for callers that must know whether anything failed
+		self.num_added = 0
+
+	def add(self, kind: str, source: str, error: Union[str, Exception], snippet: Optional[str] = None,
+			position: Optional[int] = None, department: Optional[str] = None) -> None:
+		"""Quarantine a block (or with kind "page", the whole page) that failed to parse."""
+
+		logger.warning("Quarantined %s from file %s: %s", kind, source, format_error(error))
+		if kind == "page" and snippet is None:
+			snippet = read_snippet(source)
+		self._buffer.append((self.parser, kind, source, position, department, format_error(error), snippet))
+		self.num_added += 1
+
+	def flush(self) -> None:
+		self.conn.executemany("""INSERT INTO quarantine (parser, kind, source, position, department, error, snippet)
+			VALUES (?, ?, ?, ?, ?, ?, ?)""", self._buffer)
+		self.conn.commit()
+		self._buffer = []
+
+	def resolve_source(self, source: str) -> None:
+		"""Resolve the pending items of a page about to be parsed again. Items that still fail are quarantined again."""
+
+		self.conn.execute("""UPDATE quarantine SET resolved_at=CURRENT_TIMESTAMP
+			WHERE parser=? AND source=? AND resolved_at IS NULL""", (self.parser, source))
+		self.conn.commit()
+
+	def discard(self, item_id: int) -> None:
+		self.conn.execute("DELETE FROM quarantine WHERE id=?", (item_id, ))
+		self.conn.commit()
+
+	def resolve(self, item_ids: Iterable[int]) -> None:
+		"""Mark items as parsed successfully. They are kept, for the record."""
+
+		self.conn.executemany("UPDATE quarantine SET resolved_at=CURRENT_TIMESTAMP WHERE id=?",
+			[(item_id, ) for item_id in item_ids])
+		self.conn.commit()
+
+	def pending(self, kind: Optional[str] = None) -> List[dict]:
+		"""Return the items of this parser that haven't been resolved, oldest first."""
+
+		return list_items(self.conn, self.parser, kind)
+
+	def close(self) -> None:
+		self.flush()
+		self.conn.close()
+
+
+def list_items(conn: sqlite3.Connection, parser: Optional[str] = None, kind: Optional[str] = None,
+		include_resolved: bool = False) -> List[dict]:
+	make_quarantine_table(conn)
+	q = "SELECT * FROM quarantine WHERE 1"
+	args = () # type: tuple
+	if parser is not None:
+		q += " AND parser=?"
+		args += (parser, )
+	if kind is not None:
+		q += " AND kind=?"
+		args += (kind, )
+	if not include_resolved:
+		q += " AND resolved_at IS NULL"
+	cur = conn.execute(q + " ORDER BY id", args)
+	columns = [col[0] for col in cur.description]
+	return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser()
+	parser.add_argument("--session", default=DEFAULT_SESSION,
+		help="Session to list the quarantine of (ex. 2012-2013). Default is %s" % DEFAULT_SESSION)
+	parser.add_argument("--database",
+		help="Path to SQLite database. Default is the archive database for the session")
+	parser.add_argument("--parser", choices=["calendar", "timetable"],
+		help="Only list items of this parser")
+	parser.add_argument("--all", action="store_true",
+		help="Also list items that have been resolved")
+	parser.add_argument("--show", type=int,
+		help="Print the error and raw HTML of the item with this id")
+	args = parser.parse_args()
+
+	if args.database is None:
+		args.database = session_db_path(args.session)
+
+	conn = sqlite3.connect(args.database)
+	items = list_items(conn, args.parser, include_resolved=args.all or args.show is not None)
+	if args.show is not None:
+		for item in items:
+			if item["id"] == args.show:
+				print("%s %s in %s" % (item["parser"], item["kind"], item["source"]))
+				print(item["error"])
+				print(item["snippet"])
+				break
+		else:
+			print("No quarantined item %d" % args.show)
+	else:
+		for item in items:
+			print("%d\t%s\t%s\t%s\t%s\t%s%s" % (item["id"], item["parser"], item["kind"], item["source"],
+				"" if item["position"] is None else item["position"], item["error"].splitlines()[0],
+				"\t(resolved %s)" % item["resolved_at"] if item["resolved_at"] else ""))
+		print("%d items" % len(items))
+	conn.close()
@@ -0,0 +1,372 @@
+#####################################################
+#	FIND OFFERINGS THAT FIT AN EXISTING TIMETABLE	#
+#####################################################
+
+#####################
+# 	MODULES			#
+#####################
+
+import logging
+import re
+import sqlite3
+import time
+from argparse import ArgumentParser
+from pprint import pprint
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from uoft.archive import DEFAULT_SESSION, session_db_path
+from uoft.generation import bump_generation
+
+#####################
+# 	GLOBAL VARS		#
+#####################
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = session_db_path(DEFAULT_SESSION)
+
+# columns of a section, as opposed to the offering it belongs to
+SECTION_FIELDS = ["term", "time", "location", "instructor", "waitlist", "EnrollmentCode", "EnrollmentControlLink"]
+
+DAYS = "MTWRF"
+# each day is split into half-hour slots, so a day fits in one 48-bit mask
+SLOT_MINUTES = 30
+DAY_SLOTS = 24 * 60 // SLOT_MINUTES
+# a full-year (Y) course meets in both the fall (F) and winter (S) terms
+TERM_OVERLAP = {
+	"F": ("F", "Y"),
+	"S": ("S", "Y"),
+	"Y": ("F", "S", "Y"),
+}
+
+# a chosen section, ex. "CSC108H1-L0101", "CSC108H1 T0101", or just the course code for all of its sections
+section_id_pattern = re.compile(r"^(\w\w\w\d\d\d\w\d)(?:[\s:-]*([A-Z]\d{4}))?$")
+meeting_pattern = re.compile(r"^([MTWRF]+)(\d{1,2})(?::(\d\d))?(?:-(\d{1,2})(?::(\d\d))?)?$")
+
+#####################
+# 	CODE			#
+#####################
+
+
+def _to_24_hour(hour: int) -> int:
+	"""The timetable uses 12-hour times without am/pm.
+	Classes run from 9am to 9pm, so anything before 9 is in the afternoon."""
+
+	if hour < 9:
+		return hour + 12
+	return hour
+
+
+def _slot_mask(start_min: int, end_min: int) -> int:
+	"""Return a bitmask with one bit set for every half-hour slot in [start_min, end_min)."""
+
+	mask = 0
+	for slot in range(start_min // SLOT_MINUTES, -(-end_min // SLOT_MINUTES)):
+		mask |= 1 << slot
+	return mask
+
+
+def parse_meetings(time_str: Optional[str]) -> List[Tuple[str, int, int]]:
+	"""Parse the time column of the timetable into a list of (days, start minute, end minute) meetings.
+	The column looks like "MWF10", "T2-4", "R1:30-4:30" or "M3, W2-4" (meetings joined by _update_last_row).
+	Meetings that can't be parsed (TBA, blank, header junk) are left out."""
+
+	meetings = [] # type: List[Tuple[str, int, int]]
+	if not time_str:
+		return meetings
+
+	for meeting in time_str.split(","):
+		# drop annotations such as "(p)"
+		meeting = re.sub(r"\(.*?\)", "", meeting).strip()
+		m = meeting_pattern.match(meeting)
+		if not m:
+			if meeting and meeting != "TBA":
+				logger.debug("Could not parse meeting time %s", repr(meeting))
+			continue
+
+		days, start_h, start_m, end_h, end_m = m.groups()
+		start = _to_24_hour(int(start_h)) * 60 + int(start_m or 0)
+		if end_h is None:
+			end = start + 60
+		else:
+			end = _to_24_hour(int(end_h)) * 60 + int(end_m or 0)
+			if end <= start:
+				end += 12 * 60
+		meetings.append((days, start, end))
+
+	return meetings
+
+
+def parse_time(time_str: Optional[str]) -> Dict[str, int]:
+	"""Parse the time column of the timetable into a map from day to occupied slot mask.
+	Meetings that can't be parsed occupy no slots."""
+
+	masks = {} # type: Dict[str, int]
+	for days, start, end in parse_meetings(time_str):
+		mask = _slot_mask(start, end)
+		for day in days:
+			masks[day] = masks.get(day, 0) | mask
+	return masks
+
+
+def make_slot_table(conn: sqlite3.Connection) -> None:
+	"""Create the section and time-slot occupancy tables if they don't exist.
+	timetable_sections has one row per section (lecture, tutorial, practical) of an offering,
+	since the timetable table is keyed by code and only keeps the last section it saw.
+	timetable_slots has one row per section and meeting day."""
+
+	conn.execute("""CREATE TABLE IF NOT EXISTS timetable_sections
+		(code VARCHAR, section VARCHAR, term CHAR(1), time VARCHAR, location VARCHAR, instructor VARCHAR,
+		waitlist VARCHAR, EnrollmentCode VARCHAR, EnrollmentControlLink VARCHAR,
+		PRIMARY KEY (code, section))""")
+	conn.execute("""CREATE TABLE IF NOT EXISTS timetable_slots
+		(code VARCHAR, section VARCHAR, term CHAR(1), day CHAR(1), mask INTEGER,
+		PRIMARY KEY (code, section, day))""")
+	conn.execute("CREATE INDEX IF NOT EXISTS timetable_slots_term ON timetable_slots (term)")
+	conn.commit()
+
+
+def clear_offering_index(code: str, conn: sqlite3.Connection) -> None:
+	"""Drop every section of an offering from the index, before indexing the sections it has now."""
+
+	conn.execute("DELETE FROM timetable_sections WHERE code=?", (code, ))
+	conn.execute("DELETE FROM timetable_slots WHERE code=?", (code, ))
+
+
+def index_offering(d: dict, conn: sqlite3.Connection) -> None:
+	"""Refresh the index for one section of an offering, as produced by TimetableParser.parse.
+	Does not commit, so it can share a transaction with the write of the offering itself."""
+
+	section = d.get("section") or ""
+	conn.execute("INSERT OR REPLACE INTO timetable_sections (code, section, %s) VALUES (?, ?, %s)" % (
+		", ".join(SECTION_FIELDS), ", ".join("?" * len(SECTION_FIELDS))),
+		(d["code"], section) + tuple(d.get(field) for field in SECTION_FIELDS))
+	conn.execute("DELETE FROM timetable_slots WHERE code=? AND section=?", (d["code"], section))
+	for day, mask in parse_time(d.get("time")).items():
+		conn.execute("INSERT INTO timetable_slots (code, section, term, day, mask) VALUES (?, ?, ?, ?, ?)",
+			(d["code"], section, d.get("term"), day, mask))
+
+
+def get_sections(conn: sqlite3.Connection, code: str) -> Dict[str, dict]:
+	"""Return the indexed sections of an offering, in page order, as a map from section to its columns."""
+
+	cur = conn.execute("SELECT section, %s FROM timetable_sections WHERE code=? ORDER BY rowid" % ", ".join(SECTION_FIELDS),
+		(code, ))
+	return {row[0]: dict(zip(SECTION_FIELDS, row[1:])) for row in cur.fetchall()}
+
+
+def index_offerings(offerings: Iterable[dict], conn: sqlite3.Connection) -> int:
+	"""Refresh the index for the given section rows. The sections of an offering replace all of its old ones.
+	Return the number of sections indexed."""
+
+	make_slot_table(conn)
+	n = 0
+	cleared: Set[str] = set()
+	for d in offerings:
+		if "code" not in d:
+			continue
+		if d["code"] not in cleared:
+			clear_offering_index(d["code"], conn)
+			cleared.add(d["code"])
+		index_offering(d, conn)
+		n += 1
+	conn.commit()
+	return n
+
+
+def rebuild_slot_index(conn: sqlite3.Connection) -> int:
+	"""Rebuild the slot times of every indexed section.
+	The timetable table only keeps one section per course, so sections are read from timetable_sections;
+	courses that have none there yet are indexed from the timetable table."""
+
+	make_slot_table(conn)
+	bump_generation(conn)
+	columns = ["code", "section"] + SECTION_FIELDS
+	select = ", ".join(columns)
+	cur = conn.execute("""SELECT %s FROM timetable_sections
+		UNION ALL
+		SELECT %s FROM timetable
+		WHERE code NOT IN (SELECT code FROM timetable_sections)""" % (select, select))
+	offerings = [dict(zip(columns, row)) for row in cur.fetchall()]
+	conn.execute("DELETE FROM timetable_slots")
+	return index_offerings(offerings, conn)
+
+
+def parse_section_id(section_id: str) -> Tuple[str, Optional[str]]:
+	"""Split a chosen section such as "CSC108H1-L0101" into its course code and section.
+	The section is None if only the course code was given."""
+
+	m = section_id_pattern.match(section_id.strip().upper())
+	if m is None:
+		return section_id.strip().upper(), None
+	return m.group(1), m.group(2)
+
+
+def _pack_week(day_masks: Dict[str, int]) -> Tuple[int, int]:
+	"""Pack per-day slot masks into one whole-week mask.
+	Return the week mask and a bitset of the days that have meetings."""
+
+	week = 0
+	days = 0
+	for i, day in enumerate(DAYS):
+		mask = day_masks.get(day, 0)
+		week |= mask << (i * DAY_SLOTS)
+		if mask:
+			days |= 1 << i
+	return week, days
+
+
+def _matches_breadth(breadth: str, course_breadth: Optional[str]) -> bool:
+	"""Breadth filter is either the category number (ex. "5") or part of its name."""
+
+	if not course_breadth:
+		return False
+	if breadth.isdigit():
+		return ("(%s)" % breadth) in course_breadth
+	return breadth.lower() in course_breadth.lower()
+
+
+class ScheduleIndex:
+	'''In-memory per-term occupancy index over the timetable_sections and timetable_slots tables.
+	Load it once, then answer many queries.'''
+
+	def __init__(self, conn: sqlite3.Connection):
+		make_slot_table(conn)
+
+		# (code, section) -> (term, whole-week mask, bitset of meeting days, number of occupied slots)
+		# the week mask packs the per-day masks side by side so a conflict check is a single AND
+		self.slots = {} # type: Dict[Tuple[str, str], Tuple[str, int, int, int]]
+		# (code, section) -> section row, with the name from the timetable and BreadthRequirement from the calendar
+		self.sections = {} # type: Dict[Tuple[str, str], dict]
+		# code -> its sections
+		self.by_code = {} # type: Dict[str, List[Tuple[str, str]]]
+		# term -> sections held in that term, so a query only scans its own term
+		self.by_term = {term: [] for term in TERM_OVERLAP} # type: Dict[str, List[Tuple[str, str]]]
+
+		day_masks = {} # type: Dict[Tuple[str, str], Dict[str, int]]
+		for code, section, day, mask in conn.execute("SELECT code, section, day, mask FROM timetable_slots"):
+			day_masks.setdefault((code, section), {})[day] = mask
+
+		has_courses = conn.execute(
+			"SELECT 1 FROM sqlite_master WHERE type='table' AND name='courses'").fetchone() is not None
+		q = """SELECT s.code, s.term, t.name, s.section, s.time, s.location, s.instructor, %s
+			FROM timetable_sections s LEFT JOIN timetable t ON t.code = s.code %s""" % (
+			("c.BreadthRequirement", "LEFT JOIN courses c ON c.code = s.code") if has_courses else ("NULL", ""))
+
+		columns = ["code", "term", "name", "section", "time", "location", "instructor", "BreadthRequirement"]
+		for row in conn.execute(q):
+			d = dict(zip(columns, row))
+			if d["term"] not in TERM_OVERLAP:
+				# header rows and junk
+				continue
+			key = (d["code"], d["section"])
+			week, days = _pack_week(day_masks.get(key, {}))
+			self.sections[key] = d
+			self.slots[key] = (d["term"], week, days, bin(week).count("1"))
+			self.by_code.setdefault(d["code"], []).append(key)
+			self.by_term[d["term"]].append(key)
+
+	def _chosen_keys(self, chosen: Iterable[str]) -> List[Tuple[str, str]]:
+		"""A course code on its own stands for all of its sections."""
+
+		keys = []
+		for section_id in chosen:
+			code, section = parse_section_id(section_id)
+			if section is None:
+				found = self.by_code.get(code, [])
+			else:
+				found = [(code, section)] if (code, section) in self.slots else []
+			if len(found) == 0:
+				logger.warning("No timetable entry for chosen section %s", section_id)
+			keys.extend(found)
+		return keys
+
+	def occupancy(self, chosen: Iterable[str]) -> Dict[str, Tuple[int, int]]:
+		"""Return the combined week mask and meeting days of the chosen sections,
+		as seen by a section in each term."""
+
+		occ = {term: (0, 0) for term in TERM_OVERLAP}
+		for key in self._chosen_keys(chosen):
+			chosen_term, week, days, _ = self.slots[key]
+			for term in TERM_OVERLAP[chosen_term]:
+				occ[term] = (occ[term][0] | week, occ[term][1] | days)
+		return occ
+
+	def query(self, chosen: List[str], term: str, breadth: Optional[str] = None, dept: Optional[str] = None,
+			page: int = 1, per_page: int = 25) -> dict:
+		"""Return a page of sections in the given term that don't conflict with the chosen ones.
+		Sections of courses already chosen are left out.
+		Results are ranked so that sections adding the fewest new days on campus come first,
+		then the fewest hours, then by code and section. Sections with no scheduled time (TBA) come last."""
+
+		assert term in TERM_OVERLAP
+		occ = self.occupancy(chosen)
+		chosen_codes = set(parse_section_id(section_id)[0] for section_id in chosen)
+		busy_days = occ[term][1]
+		dept = dept.upper() if dept else None
+
+		ranked = []
+		for t in TERM_OVERLAP[term]:
+			busy = occ[t][0]
+			for key in self.by_term[t]:
+				code = key[0]
+				_, week, days, num_slots = self.slots[key]
+				if week & busy or code in chosen_codes:
+					continue
+				if dept and not code.startswith(dept):
+					continue
+				if breadth and not _matches_breadth(breadth, self.sections[key]["BreadthRequirement"]):
+					continue
+
+				new_days = bin(days & ~busy_days).count("1")
+				ranked.append(((week == 0, new_days, num_slots, key), key))
+
+		ranked.sort()
+		start = (page - 1) * per_page
+		return {
+			"total": len(ranked),
+			"page": page,
+			"per_page": per_page,
+			"results": [self.sections[key] for _, key in ranked[start:start + per_page]],
+		}
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser()
+	parser.add_argument("--database", default=DB_PATH,
+		help="Path to SQLite database")
+	parser.add_argument("-s", "--sections", nargs="*", default=[],
+		help="Sections already in your timetable (ex. CSC108H1-L0101). A course code alone means all of its sections")
+	parser.add_argument("-t", "--term", choices=sorted(TERM_OVERLAP.keys()), default="F",
+		help="Term to search in. Full-year (Y) offerings are included in F and S")
+	parser.add_argument("-b", "--breadth",
+		help="Only include courses in this breadth category (number or part of its name)")
+	parser.add_argument("--dept",
+		help="Only include courses with this code prefix (ex. CSC)")
+	parser.add_argument("-p", "--page", type=int, default=1)
+	parser.add_argument("-n", "--per-page", type=int, default=25)
+	parser.add_argument("--rebuild-index", action="store_true",
+		help="Rebuild the time-slot index first")
+	parser.add_argument("-v", "--verbose", action="store_true",
+		help="Enable verbose logging")
+	args = parser.parse_args()
+
+	logging.basicConfig(level=(logging.DEBUG if args.verbose else logging.WARNING))
+
+	conn = sqlite3.connect(args.database)
+	if args.rebuild_index:
+		n = rebuild_slot_index(conn)
+		print("Indexed %d sections" % n)
+
+	index = ScheduleIndex(conn)
+	if len(index.sections) == 0:
+		logger.warning("The schedule index is empty. Write the timetable pages to the database to build it")
+	start_time = time.perf_counter()
+	result = index.query(args.sections, args.term, breadth=args.breadth, dept=args.dept,
+		page=args.page, per_page=args.per_page)
+	logger.info("Query took %.3f ms", (time.perf_counter() - start_time) * 1000)
+
+	print("Found %d sections that fit (page %d)" % (result["total"], result["page"]))
+	for offering in result["results"]:
+		pprint(offering)
+	conn.close()
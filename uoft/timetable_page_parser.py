@@ -7,23 +7,34 @@
 # 	MODULES			#
 #####################
 
+import gc  # for bounding memory in streaming mode
 import logging
 import os
 import pickle as pickler  # for saving inventory...
 import re  # for soup matching
 import sqlite3
+import sys
 import traceback  # for tracing SQL exceptions
 import urllib.error
 import urllib.parse
 import urllib.request  # for downloading web pages
 from argparse import ArgumentParser
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple
 
 import coloredlogs
 import requests
 from bs4 import BeautifulSoup
 from pprint import pprint
 
+from uoft.archive import (DEFAULT_SESSION, SessionMismatchError, add_column_if_missing, check_database_session,
+	check_session, make_session_dir, session_db_path)
+from uoft.changelog import get_row, prune_rows, record_sections_write, record_write, track_codes
+from uoft.course_documents import materialize
+from uoft.course_search import build_search_index
+from uoft.generation import bump_generation
+from uoft.quarantine import Quarantine
+from uoft.schedule_query import clear_offering_index, get_sections, index_offering, make_slot_table
+
 #########################
 # 	GLOBAL VARS			#
 #########################
@@ -34,7 +45,11 @@ logger.setLevel(level=logging.DEBUG)
 course_code_pattern = r"\w\w\w\d\d\d\w\d"
 PAGES_DIR = "tables"
 DATA_FILE = "timetable_inventory.data"
-DB_PATH = "./data/archive-capture-2012-2013/courses-new.db"
+DB_PATH = session_db_path(DEFAULT_SESSION)
+# how much of the page to read at a time in streaming mode
+CHUNK_SIZE = 64 * 1024
+# each BeautifulSoup tree is a reference cycle, so collect them every this many rows in streaming mode
+GC_EVERY = 1000
 
 #########################
 # 	UTILITY FUNCTIONS	#
@@ -66,8 +81,9 @@ class TimetableParser:
 	'''This object is used to extract information from the timetable webpage.'''
 
 	@staticmethod
-	def parse(page_file_path: str) -> List[dict]:
-		'''The main method. Given a path to the web page, extract timetable info and return it as a list of dictionaries.'''
+	def parse(page_file_path: str, quarantine: Optional[Quarantine] = None) -> List[dict]:
+		'''The main method. Given a path to the web page, extract timetable info and return it as a list of dictionaries.
+		Pages and rows that fail to parse are added to quarantine, if given.'''
 
 		logger.debug("Trying to parse file %s", page_file_path)
 
@@ -81,19 +97,23 @@ class TimetableParser:
 
 			if dept_name is None:
 				print("[ERROR] Could not extract department name")
+				if quarantine is not None:
+					quarantine.add("page", page_file_path, "Could not extract department name")
 			else:
 				main_soup = TimetableParser._get_functional_soup(soup, dept_name)
 				# print main_soup
 
 				if main_soup is None:
 					print("[ERROR] Failed to extract functional soup")
+					if quarantine is not None:
+						quarantine.add("page", page_file_path, "Failed to extract functional soup")
 				else:
 					course_list = TimetableParser._get_course_list(main_soup)
 
 					if len(course_list) == 0:
 						print("[WARNING] No courses found on page")
 
-					for course_html in course_list:
+					for i, course_html in enumerate(course_list):
 						last_row = l[-1] if len(l) > 0 else None
 						d = TimetableParser._get_course_info(course_html, last_row)
 
@@ -103,6 +123,8 @@ class TimetableParser:
 							# this is a sign that there is an error
 							print("[WARNING] No info extracted from matched row")
 							print(course_html)
+							if quarantine is not None:
+								quarantine.add("row", page_file_path, "No info extracted from matched row", course_html, i)
 						else:
 							l.append(d)
 
@@ -114,6 +136,107 @@ class TimetableParser:
 			logging.error(e)
 			raise e
 
+	@staticmethod
+	def iter_parse(page_file_path: str, chunk_size: int = CHUNK_SIZE, quarantine: Optional[Quarantine] = None) -> Iterator[dict]:
+		'''Streaming version of parse. Read the page a chunk at a time and yield one offering at a time,
+		so memory use stays constant however large the page is.
+		An offering is only yielded once the next one starts, since continuation rows update the previous row.'''
+
+		logger.debug("Trying to parse file %s in streaming mode", page_file_path)
+
+		try:
+			with open(page_file_path, "r") as page_file:
+				header_html, rest = TimetableParser._read_until_table(page_file, chunk_size)
+				dept_name = TimetableParser._get_department_name(BeautifulSoup(header_html, features="html.parser"))
+
+				if dept_name is None:
+					print("[ERROR] Could not extract department name")
+					if quarantine is not None:
+						quarantine.add("page", page_file_path, "Could not extract department name")
+					return
+
+				last_row = None # type: Optional[dict]
+				for i, course_html in enumerate(TimetableParser._iter_course_list(page_file, rest, chunk_size)):
+					d = TimetableParser._get_course_info(html_to_str(course_html), last_row)
+					if i % GC_EVERY == GC_EVERY - 1:
+						gc.collect()
+
+					if d is None:
+						pass # no info extracted, junk row
+					elif len(d) == 0:
+						# this is a sign that there is an error
+						print("[WARNING] No info extracted from matched row")
+						print(course_html)
+						if quarantine is not None:
+							quarantine.add("row", page_file_path, "No info extracted from matched row", course_html, i)
+					else:
+						if last_row is not None:
+							yield last_row
+						last_row = d
+
+				if last_row is None:
+					print("[WARNING] No courses found on page")
+				else:
+					yield last_row
+		except PageParseException as e:
+			logging.error("Failed to parse file: %s", page_file_path)
+			logging.error(e)
+			raise e
+
+	@staticmethod
+	def _read_until_table(page_file: TextIO, chunk_size: int) -> Tuple[str, str]:
+		'''Read the page up to the start of the timetable.
+		Return the HTML before the table (which holds the department name) and whatever was read past it.'''
+
+		table_re = re.compile(r"<table[\s>]", re.IGNORECASE)
+		buf = ""
+		while True:
+			chunk = page_file.read(chunk_size)
+			buf += chunk
+			m = table_re.search(buf)
+			if m is not None:
+				return buf[:m.start()], buf[m.end():]
+			if chunk == "":
+				raise PageParseException("Could not find timetable on page")
+
+	@staticmethod
+	def _iter_course_list(page_file: TextIO, buf: str, chunk_size: int) -> Iterator[str]:
+		'''Streaming version of _get_course_list.
+		Yield the HTML of each row of the timetable once the next row (or the end of the table) has been read.'''
+
+		row_re = re.compile(r"<tr[\s>]", re.IGNORECASE)
+		end_re = re.compile(r"</table>", re.IGNORECASE)
+		row_start = None # type: Optional[int]
+		done = False
+
+		while not done:
+			chunk = page_file.read(chunk_size)
+			done = (chunk == "")
+			buf += chunk
+
+			m = end_re.search(buf)
+			if m is not None:
+				buf = buf[:m.start()]
+				done = True
+
+			pos = 0 if row_start is None else row_start + 1
+			m = row_re.search(buf, pos)
+			while m is not None:
+				if row_start is not None:
+					yield buf[row_start:m.start()]
+				row_start = m.start()
+				m = row_re.search(buf, row_start + 1)
+
+			if row_start is None:
+				# nothing before the first row is part of the table we care about
+				buf = buf[-16:]
+			else:
+				buf = buf[row_start:]
+				row_start = 0
+
+		if row_start is not None:
+			yield buf[row_start:]
+
 	@staticmethod
 	def _get_department_name(all_soup: BeautifulSoup) -> str:
 		'''Given the HTML soup for a page, extract the department name and return it.
@@ -166,6 +289,10 @@ class TimetableParser:
 		row_soup = BeautifulSoup(html_string, "html.parser")
 		cols = row_soup.findAll("td")
 
+		if len(cols) == 0:
+			# heading row, not a failure
+			return None
+
 		col_headings = ["code", "term", "name", "section", "waitlist", "time", "location", "instructor", "EnrollmentCode", "EnrollmentControlLink"]
 
 		for index, col in enumerate(cols):
@@ -214,22 +341,36 @@ class TimetableParser:
 class DBHelp:
 	'''Helps out with some insertion logistics.'''
 
-	def __init__(self, db_path: str):
-		'''Create the table, connection, and other resources to interact with DB.'''
+	def __init__(self, db_path: str, session: str = DEFAULT_SESSION):
+		'''Create the table, connection, and other resources to interact with DB.
+		Rows written through this object are tagged with the given session.
+		Raises SessionMismatchError if the database holds the offerings of another session.'''
 
 		self._db_path = db_path
+		self.session = session
+		make_session_dir(self._db_path)
 		self.conn = sqlite3.connect(self._db_path) # create a connection
 		self.cursor = self.conn.cursor()
+		make_slot_table(self.conn)
 
 		# create table just in case
 		self._query("""CREATE TABLE IF NOT EXISTS timetable
 			(code VARCHAR, term CHAR(1), name VARCHAR, section VARCHAR, waitlist VARCHAR, time VARCHAR, location VARCHAR, instructor VARCHAR,
-			EnrollmentCode VARCHAR, EnrollmentControlLink VARCHAR,
+			EnrollmentCode VARCHAR, EnrollmentControlLink VARCHAR, session VARCHAR,
 			PRIMARY KEY (code))""")
+		# databases captured before sessions were tracked
+		add_column_if_missing(self.conn, "timetable", "session")
 		self.conn.commit() # commit so can insert later
+		try:
+			check_session(self.conn, "timetable", session)
+		except SessionMismatchError:
+			self.cursor.close()
+			self.conn.close()
+			raise
 
 	def _insert(self, d):
-		'''Insert given dictionary as a row into the table.'''
+		'''Insert given dictionary as a row into the table.
+		Every section of an offering is written to the same row, so changes are recorded by write_to_db instead.'''
 
 		if "code" in d:
 			code = d.pop("code")
@@ -242,10 +383,10 @@ class DBHelp:
 			placeholder = ", ".join(["%s=?" % k for k in keys]) # placeholder for update values
 
 			if len(placeholder.strip()) > 0:
-				q = "UPDATE timetable SET %s WHERE code=?" % (placeholder)
+				q = "UPDATE timetable SET %s, session=? WHERE code=?" % (placeholder)
 
 				# execute the update query
-				t = tuple([d[k] for k in keys]) + (code, )
+				t = tuple([d[k] for k in keys]) + (self.session, code)
 
 				# re-add code to the dictionary
 				d["code"] = code
@@ -328,23 +469,41 @@ def get_links_from_main_page(main_page_name: str) -> dict:
 
 	return d
 
-def write_to_db(l: list, db) -> int:
-	'''Given a list of rows to write to the database, write them.'''
+def write_to_db(l: Iterable[dict], db) -> int:
+	'''Given rows to write to the database, write them and keep the time-slot index up to date.
+	Rows are only read once, so l can be a generator from TimetableParser.iter_parse.
+	Each offering's net change over all of its sections, and the sections that changed, are recorded in the changelog.'''
 
 	num_inserts = 0
+	# row and sections of each offering written so far, as they were before this write.
+	# Its old sections have been dropped from the index, since the page lists all of them
+	before: Dict[str, Optional[dict]] = {}
+	before_sections: Dict[str, Dict[str, dict]] = {}
 
 	for row_dict in l:
 		if "code" in row_dict:
+			code = row_dict["code"]
+			if code not in before:
+				before[code] = get_row(db.conn, "timetable", code)
+				before_sections[code] = get_sections(db.conn, code)
+				clear_offering_index(code, db.conn)
+			index_offering(row_dict, db.conn)
 			num_inserts += db._insert(row_dict)
 
+	for code, row in before.items():
+		record_write(db.conn, "timetable", code, row, get_row(db.conn, "timetable", code))
+		record_sections_write(db.conn, code, before_sections[code], get_sections(db.conn, code))
+
 	return num_inserts
 
 
-def read_write_pg(html_file_path: str, db_path: str) -> None:
+def read_write_pg(html_file_path: str, db_path: str, session: str = DEFAULT_SESSION) -> None:
 	l = TimetableParser.parse(html_file_path)
 
-	db = DBHelp(db_path)
+	db = DBHelp(db_path, session)
 	num_lines = write_to_db(l, db)
+	if num_lines > 0:
+		bump_generation(db.conn)
 	logger.info("[TRACE] Parsed file %s. Wrote %d rows to DB", html_file_path, num_lines)
 	db.close()
 
@@ -383,10 +542,21 @@ def get_offering_files(dir: str) -> List[str]:
 	return l
 
 
-def print_or_write(offerings: List[dict], db_path: str, source_file: str, output: str = "stdout"):
+def print_or_write(offerings: Iterable[dict], db_path: str, source_file: str, output: str = "stdout",
+		session: str = DEFAULT_SESSION):
 	if output == "database":
-		db = DBHelp(db_path)
-		num_lines = write_to_db(offerings, db)
+		db = DBHelp(db_path, session)
+		try:
+			num_lines = write_to_db(offerings, db)
+		except Exception:
+			# offerings can be a stream that fails part way through the page.
+			# Drop its partial writes and release the database, so the page can be quarantined and retried as a whole
+			db.conn.rollback()
+			db.cursor.close()
+			db.conn.close()
+			raise
+		if num_lines > 0:
+			bump_generation(db.conn)
 		logger.info("[TRACE] Parsed file %s. Wrote %d rows to DB", source_file, num_lines)
 		db.close()
 	else:
@@ -400,10 +570,18 @@ if __name__ == "__main__":
 		help="Parse the given timetable file")
 	parser.add_argument("-d", "--dir",
 		help="Parse all of the timetable files in the given directory")
-	parser.add_argument("--database", default=DB_PATH,
-		help="Path to SQLite database")
+	parser.add_argument("--session", default=DEFAULT_SESSION,
+		help="Session the pages were captured from (ex. 2012-2013). Default is %s" % DEFAULT_SESSION)
+	parser.add_argument("--database",
+		help="Path to SQLite database. Default is the archive database for the session")
 	parser.add_argument("-o", "--output", choices=["stdout", "database"],
 		help="By default output everything to database")
+	parser.add_argument("--stream", action="store_true",
+		help="Read pages incrementally and handle one offering at a time. Use this for very large pages")
+	parser.add_argument("--prune", action="store_true",
+		help="With --dir and database output, delete offerings that weren't found on any page")
+	parser.add_argument("--retry-quarantine", action="store_true",
+		help="With database output, parse only the files that had failures before (see uoft/quarantine.py)")
 	parser.add_argument("-v", "--verbose", action="store_true",
 		help="Enable verbose logging")
 	args = parser.parse_args()
@@ -413,19 +591,93 @@ if __name__ == "__main__":
 	coloredlogs.install(log_level)
 	logger.setLevel(log_level)
 
-	if args.file:
-		offerings = TimetableParser.parse(args.file)
-		print_or_write(offerings, args.database, output=args.output, source_file=args.file)
+	if args.database is None:
+		args.database = session_db_path(args.session)
+	elif args.output == "database":
+		try:
+			check_database_session(args.database, "timetable", args.session)
+		except SessionMismatchError as e:
+			parser.error(str(e))
+
+	parse_page = (TimetableParser.iter_parse if args.stream else TimetableParser.parse)
+	# failures are only quarantined when writing to the database
+	quarantine = (Quarantine(args.database, "timetable") if args.output == "database" else None)
+
+	def parse_and_write(path: str, seen: Optional[Set[str]] = None) -> bool:
+		'''Parse the page and output its offerings. Return False if the page couldn't be parsed,
+		in which case it is quarantined (when writing to the database) and the run carries on.'''
+
+		if quarantine is not None:
+			quarantine.resolve_source(path)
+		try:
+			offerings = parse_page(path, quarantine=quarantine) # type: Iterable[dict]
+			if seen is not None:
+				offerings = track_codes(offerings, seen)
+			print_or_write(offerings, args.database, output=args.output, source_file=path, session=args.session)
+			return True
+		except Exception as e:
+			logging.error("Failed to parse file: %s", path)
+			logging.error(e)
+			if quarantine is not None:
+				quarantine.add("page", path, e)
+			return False
+		finally:
+			if quarantine is not None:
+				quarantine.flush()
+
+	if args.retry_quarantine:
+		if quarantine is None:
+			parser.error("--retry-quarantine needs --output database")
+		# rows continue the row before them, so a page with any quarantined rows is parsed again as a whole
+		retry_pages = sorted(set(item["source"] for item in quarantine.pending()))
+		for path in retry_pages:
+			parse_and_write(path)
+		logger.info("[TRACE] Parsed %d quarantined files again. %d items are still quarantined",
+			len(retry_pages), len(quarantine.pending()))
+	elif args.file:
+		if not parse_and_write(args.file):
+			sys.exit(1)
 	elif args.dir:
 		blacklist = frozenset([
 			# NOTE: currently cannot parse this file
 			"data/archive-capture-2012-2013/timetable-files/Arts & Science 2012-2013 Fall_Winter Session Timetable for_ Anatomy [First Year Seminars].htm"
 		])
+		# offerings seen in this run, for --prune
+		seen = set() # type: Set[str]
+		failed = []
 		for path in get_offering_files(args.dir):
 			if path in blacklist:
 				logging.debug("Skipping blacklisted file: %s", path)
 				continue
-			offerings = TimetableParser.parse(path)
-			print_or_write(offerings, args.database, output=args.output, source_file=path)
+			if not parse_and_write(path, seen):
+				failed.append(path)
+		if len(failed) > 0:
+			logger.warning("Failed to parse %d files. Fix the parser and rerun with --retry-quarantine", len(failed))
+		if args.prune and args.output == "database":
+			assert quarantine is not None
+			if quarantine.num_added > 0:
+				# the offerings on the failed pages and the quarantined rows weren't seen, but are still in the timetable
+				logger.warning("Not pruning, since some files or rows failed to parse")
+			else:
+				db = DBHelp(args.database, args.session)
+				num_deletes = prune_rows(db.conn, "timetable", seen)
+				if num_deletes > 0:
+					db._query("DELETE FROM timetable_slots WHERE code NOT IN (SELECT code FROM timetable)")
+					db._query("DELETE FROM timetable_sections WHERE code NOT IN (SELECT code FROM timetable)")
+					bump_generation(db.conn)
+				logger.info("[TRACE] Deleted %d offerings that are no longer in the timetable", num_deletes)
+				db.close()
 	else:
 		print("nothing to do")
+
+	if quarantine is not None:
+		quarantine.close()
+
+	if args.output == "database" and (args.file or args.dir or args.retry_quarantine):
+		# bring the joined per-course documents and the lookup index up to date with what was just written
+		conn = sqlite3.connect(args.database)
+		n = materialize(conn)
+		logger.info("[TRACE] Rebuilt %d course documents", n)
+		if n > 0:
+			logger.info("[TRACE] Indexed %d courses for lookup", build_search_index(conn))
+		conn.close()